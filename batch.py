@@ -0,0 +1,217 @@
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from json import dump
+from logging import basicConfig, DEBUG, INFO
+from multiprocessing import (
+    freeze_support,
+    get_all_start_methods,
+    set_start_method,
+)
+from os import listdir
+from os.path import isdir, join
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+import sys
+
+from tqdm import tqdm
+
+from utils.config import read_config
+from utils.engines import pool_stats
+from utils.metrics import log_to_file, profiled
+
+RUNNERS = ['main', 'mssql', 'wip']
+
+_DB_KEYS = ('database_server', 'database_port', 'database')
+
+
+def collect_jobs(paths, params='', jobs_file=None):
+    # Задание -- это конфиг выгрузки и параметры для него (как -p у
+    # main.py). Каталоги раскрываются во все *.yml внутри
+    jobs = []
+    for path in paths:
+        if isdir(path):
+            jobs += [
+                {'config': join(path, name), 'params': params}
+                for name in sorted(listdir(path))
+                if name.endswith(('.yml', '.yaml'))
+            ]
+        else:
+            jobs.append({'config': path, 'params': params})
+    if jobs_file:
+        for job in read_config(jobs_file).get('jobs', []):
+            if isinstance(job, str):
+                job = {'config': job}
+            jobs.append({'params': '', **job})
+    return jobs
+
+
+class DbLimits(object):
+    # Не больше limit одновременных заданий на одну базу (сервер, порт,
+    # имя); задание, которое пишет в output_db, занимает место и там.
+    # Семафоры берутся в одном порядке, чтобы задания не ждали друг друга
+    # по кругу
+
+    def __init__(self, limit, overrides=None):
+        self._limit = limit
+        self._overrides = overrides or {}
+        self._semaphores = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def make_key(db_config):
+        return '{}:{}/{}'.format(
+            *(db_config.get(key, '') for key in _DB_KEYS)
+        )
+
+    def _semaphore(self, key):
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = BoundedSemaphore(
+                    self._overrides.get(key, self._limit)
+                )
+            return self._semaphores[key]
+
+    def acquire(self, config):
+        keys = sorted({
+            self.make_key(config[block])
+            for block in ['db', 'output_db'] if block in config
+        })
+        semaphores = [self._semaphore(key) for key in keys]
+        for semaphore in semaphores:
+            semaphore.acquire()
+        return semaphores
+
+
+def run_job(job, limits):
+    config = read_config(job['config'])
+    runner = job.get('runner', 'main')
+    semaphores = limits.acquire(config)
+    start = perf_counter()
+    try:
+        # Модули выгрузок импортируются один раз на весь процесс
+        if runner == 'mssql':
+            import main_mssql
+            main_mssql.run(config)
+        elif runner == 'wip':
+            import main_wip_imz
+            main_wip_imz.run(config, job.get('refresh', False))
+        elif runner == 'main':
+            import main
+            main.run(config, job.get('params', ''))
+        else:
+            raise ValueError(f'Неизвестный runner {runner!r}, '
+                             f'допустимы: {", ".join(RUNNERS)}')
+    finally:
+        for semaphore in reversed(semaphores):
+            semaphore.release()
+    return perf_counter() - start
+
+
+def run_batch(jobs, workers=4, db_limit=2, db_overrides=None):
+    limits = DbLimits(db_limit, db_overrides)
+    results = []
+    start = perf_counter()
+    with ThreadPoolExecutor(workers, thread_name_prefix='job') as executor:
+        futures = {
+            executor.submit(run_job, job, limits): job for job in jobs
+        }
+        for future in as_completed(futures):
+            job = futures[future]
+            result = {
+                'config': job['config'],
+                'params': job.get('params', ''),
+                'runner': job.get('runner', 'main'),
+            }
+            try:
+                result['seconds'] = round(future.result(), 2)
+                result['status'] = 'ok'
+            except Exception as e:
+                result['status'] = 'error'
+                result['error'] = repr(e)
+            results.append(result)
+            tqdm.write(f'[{len(results)}/{len(jobs)}] {job["config"]}: '
+                       f'{result["status"]}')
+    return {
+        'seconds': round(perf_counter() - start, 2),
+        'jobs': results,
+        'pools': pool_stats(),
+    }
+
+
+def print_summary(report):
+    ok = [job for job in report['jobs'] if job['status'] == 'ok']
+    failed = [job for job in report['jobs'] if job['status'] != 'ok']
+    for job in sorted(ok, key=lambda job: -job['seconds']):
+        tqdm.write(f'  {job["seconds"]:8.2f} с  {job["config"]} '
+                   f'{job["params"]}')
+    for job in failed:
+        tqdm.write(f'  ОШИБКА     {job["config"]} {job["params"]}: '
+                   f'{job["error"]}')
+    for pool in report['pools']:
+        tqdm.write(f'  {pool["database_server"]}/{pool["database"]}: '
+                   f'{pool["checkouts"]} обращений, '
+                   f'{pool["connections"]} соединений, '
+                   f'ожидание {pool["wait_time"]:.2f} с')
+    tqdm.write(f'Выполнено {len(ok)} из {len(report["jobs"])} заданий '
+               f'за {report["seconds"]:.2f} с')
+
+
+if __name__ == '__main__':
+    freeze_support()
+
+    parser = ArgumentParser(
+        description='Выполнение многих выгрузок в одном процессе: общие '
+                    'пулы соединений и ограничение одновременных заданий '
+                    'на каждую базу.'
+    )
+    parser.add_argument('configs', nargs='*',
+                        help='Конфиги выгрузок или каталоги с ними')
+    parser.add_argument('-j', '--jobs', required=False, default=None,
+                        help='YAML со списком jobs: config, params, runner '
+                             '(main, mssql, wip)')
+    parser.add_argument('-p', '--params', required=False, default='',
+                        help='Параметры для конфигов из командной строки')
+    parser.add_argument('-w', '--workers', required=False, type=int,
+                        default=None)
+    parser.add_argument('--db-concurrency', required=False, type=int,
+                        default=None,
+                        help='Одновременных заданий на одну базу')
+    parser.add_argument('-r', '--report', required=False,
+                        default='batch_report.json')
+    parser.add_argument('-d', '--debug', required=False, action='store_true',
+                        default=False)
+    parser.add_argument('--metrics-log', required=False, default=None,
+                        help='Файл для записей об этапах (JSON Lines)')
+    parser.add_argument('--profile', required=False, default=None,
+                        help='Файл для профиля cProfile')
+
+    args = parser.parse_args()
+
+    basicConfig(level=args.debug and DEBUG or INFO)
+    if args.metrics_log:
+        log_to_file(args.metrics_log)
+
+    # Процессы записи XLSX/XML запускаются из потоков заданий: fork из
+    # многопоточного процесса может унаследовать чужие блокировки
+    if 'forkserver' in get_all_start_methods() \
+            and not getattr(sys, 'frozen', False):
+        set_start_method('forkserver')
+
+    settings = read_config(args.jobs) if args.jobs else {}
+    jobs = collect_jobs(args.configs, args.params, args.jobs)
+    if not jobs:
+        parser.error('Не заданы конфиги выгрузок')
+
+    with profiled(args.profile):
+        report = run_batch(
+            jobs,
+            args.workers or settings.get('workers', 4),
+            args.db_concurrency or settings.get('db_concurrency', 2),
+            settings.get('db_limits')
+        )
+
+    print_summary(report)
+    with open(args.report, 'w', encoding='utf-8') as f:
+        dump(report, f, ensure_ascii=False, indent=2)
+    if any(job['status'] != 'ok' for job in report['jobs']):
+        sys.exit(1)
@@ -0,0 +1,285 @@
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dump, dumps, load
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+from benchmarks.bench_wip_transform import make_wip
+from ia_api.iaimportexport import IAImportExport
+from main import DATE_COLUMNS, copy_to_pg, read_config, save_to_pg, script
+from main_wip_imz import transform_wip
+from utils.dates import parse_iso_dates, resolve_date_columns
+from utils.dtypes import optimize_dtypes
+from utils.writers import SINKS, ParallelWriter
+
+try:
+    from resource import RUSAGE_SELF, getrusage
+except ImportError:
+    getrusage = None
+
+SHAPES = ['mixed', 'dates', 'text']
+
+
+def peak_rss_mb():
+    # ru_maxrss -- пик за всё время процесса (в КБ на Linux), поэтому для
+    # каждого этапа это максимум на момент его окончания
+    if getrusage is None:
+        return None
+    return round(getrusage(RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def measure(stages, name, rows, func, *args, **kwargs):
+    start = perf_counter()
+    value = func(*args, **kwargs)
+    elapsed = perf_counter() - start
+    stages[name] = {
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(rows / max(elapsed, 1e-9)),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    print(f'{name}: {elapsed:.2f} с, '
+          f'{stages[name]["rows_per_sec"]} строк/с, '
+          f'пик RSS {stages[name]["peak_rss_mb"]} МБ')
+    return value
+
+
+def make_table(rows, columns, shape):
+    rng = np.random.default_rng(0)
+    dates = pd.Timestamp('2023-01-01', tz='Europe/Moscow') \
+        + pd.to_timedelta(rng.integers(0, 10 ** 8, rows), unit='s')
+    iso_dates = pd.Series(
+        dates.strftime('%Y-%m-%dT%H:%M:%S.123000+03:00')
+    )
+    words = np.array(['alpha', 'beta', 'gamma', 'delta', 'epsilon',
+                      'zeta', 'eta', 'theta'])
+
+    # Столбцы с датами называются как в DATE_COLUMNS, чтобы save_to_pg
+    # разбирал их так же, как в рабочей выгрузке
+    kinds = {
+        'mixed': ['int', 'float', 'text', 'date'],
+        'dates': ['date', 'date', 'date', 'int'],
+        'text': ['text', 'text', 'text', 'int'],
+    }[shape]
+    data = {'id': np.arange(rows)}
+    for i in range(1, columns):
+        kind = kinds[i % len(kinds)]
+        if kind == 'int':
+            data[f'int_{i}'] = rng.integers(0, 10 ** 6, rows)
+        elif kind == 'float':
+            data[f'float_{i}'] = rng.random(rows)
+        elif kind == 'text':
+            data[f'text_{i}'] = np.char.add(
+                rng.choice(words, rows),
+                rng.integers(0, 1000, rows).astype(str)
+            )
+        else:
+            name = DATE_COLUMNS[i % len(DATE_COLUMNS)]
+            data[name if name not in data else f'{name}_{i}'] = iso_dates
+    return pd.DataFrame(data)
+
+
+def make_ia_collections(entities, phases=60, operations_per_route=5):
+    return {
+        'entity': [
+            {'id': i, 'identity': f'E{i}'} for i in range(entities)
+        ],
+        'entity_route': [
+            {'id': i, 'entity_id': i, 'alternate': False}
+            for i in range(entities)
+        ],
+        'entity_route_phase': [
+            {'id': i, 'identity': f'PH{i}'} for i in range(phases)
+        ],
+        'operation': [
+            {
+                'id': i * operations_per_route + k,
+                'identity': f'OP{i}_{k}',
+                'nop': k * 10,
+                'entity_route_id': i,
+                'entity_route_phase_id': (i + k) % phases,
+            }
+            for i in range(entities)
+            for k in range(operations_per_route)
+        ],
+    }
+
+
+def start_mock_ia(collections):
+    # Отвечает так же, как rest/collection IA: окно строк [start, stop)
+    # и общее число строк в meta.count
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, data):
+            body = dumps(data).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self._send({'data': {}})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            table = url.path.rsplit('/', 1)[-1]
+            query = parse_qs(url.query)
+            rows = collections[table]
+            start = int(query['start'][0])
+            stop = int(query['stop'][0])
+            self._send({
+                'meta': {'count': len(rows)},
+                table: rows[start:stop],
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_ia(stages, args):
+    collections = make_ia_collections(args.ia_entities)
+    server = start_mock_ia(collections)
+    ia_rows = sum(len(rows) for rows in collections.values())
+    wip = make_wip(args.rows)
+    try:
+        with IAImportExport(
+                'login', 'password',
+                f'http://127.0.0.1:{server.server_port}/',
+                concurrency=args.ia_concurrency,
+                page_size=args.ia_page_size
+        ) as ia:
+            measure(stages, 'ia_fetch', ia_rows, lambda: (
+                ia._get_route_index(),
+                ia.get_entity_id('E0'),
+            ))
+            measure(stages, 'ia_transform', len(wip), transform_wip, wip, ia)
+    finally:
+        server.shutdown()
+
+
+def bench_export(stages, args, directory):
+    df = make_table(args.rows, args.columns, args.shape)
+    rows = len(df)
+
+    # Источник: Postgres из конфига или SQLite-файл во временном каталоге
+    if args.config:
+        config = read_config(args.config)
+        source = config['db']
+        target = config.get('output_db', source)
+        copy_to_pg(source, df, 'bench_source', 'replace', 100000)
+        df = measure(stages, 'read', rows, script, source,
+                     'select * from bench_source')
+    else:
+        engine = create_engine(f'sqlite:///{join(directory, "bench.db")}')
+        df.to_sql('bench_source', engine, index=False, chunksize=10000)
+        df = measure(stages, 'read', rows, pd.read_sql,
+                     'select * from bench_source', engine)
+
+    def parse_dates(frame):
+        frame = frame.copy(deep=False)
+        for column in resolve_date_columns(frame, DATE_COLUMNS):
+            frame[column] = parse_iso_dates(frame[column])
+        return frame
+
+    parsed = measure(stages, 'dates', rows, parse_dates, df)
+    if args.optimize:
+        parsed = measure(stages, 'optimize_dtypes', rows,
+                         optimize_dtypes, parsed)
+
+    writer = ParallelWriter(
+        join(directory, 'bench'),
+        args.formats,
+        parallel=False
+    )
+    writer.write(parsed)
+    writer.close()
+    for extension, elapsed in writer.timings.items():
+        stages[f'write_{extension}'] = {
+            'seconds': round(elapsed, 3),
+            'rows_per_sec': round(rows / max(elapsed, 1e-9)),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+    if args.config:
+        measure(stages, 'load', rows, save_to_pg,
+                {**target, 'method': 'copy'}, df, 'bench_target', 'replace')
+    else:
+        measure(stages, 'load', rows, parsed.to_sql, 'bench_target', engine,
+                if_exists='replace', index=False, chunksize=10000)
+        engine.dispose()
+
+
+def compare(stages, previous):
+    for name, stage in stages.items():
+        if name not in previous:
+            continue
+        ratio = previous[name]['seconds'] / max(stage['seconds'], 1e-9)
+        print(f'{name}: {previous[name]["seconds"]:.2f} -> '
+              f'{stage["seconds"]:.2f} с ({ratio:.2f}x)')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Замер этапов выгрузки на синтетических данных: '
+                    'чтение, разбор дат, запись каждого формата, загрузка '
+                    'в базу и получение данных из IA (через локальный '
+                    'макет REST). Без -c источником служит SQLite.'
+    )
+    parser.add_argument('-c', '--config', required=False, default=None,
+                        help='Конфиг с db (и output_db) для замера на '
+                             'Postgres')
+    parser.add_argument('-r', '--rows', required=False, type=int,
+                        default=100000)
+    parser.add_argument('--columns', required=False, type=int, default=12)
+    parser.add_argument('--shape', required=False, choices=SHAPES,
+                        default='mixed')
+    parser.add_argument('-f', '--formats', required=False, nargs='+',
+                        choices=list(SINKS), default=None)
+    parser.add_argument('--optimize', required=False, action='store_true',
+                        default=False, help='Замерить и optimize_dtypes')
+    parser.add_argument('--ia-entities', required=False, type=int,
+                        default=20000)
+    parser.add_argument('--ia-page-size', required=False, type=int,
+                        default=10000)
+    parser.add_argument('--ia-concurrency', required=False, type=int,
+                        default=4)
+    parser.add_argument('--skip-ia', required=False, action='store_true',
+                        default=False)
+    parser.add_argument('-o', '--output', required=False,
+                        default='bench_pipeline.json')
+    parser.add_argument('--compare', required=False, default=None,
+                        help='JSON прошлого запуска для сравнения')
+
+    args = parser.parse_args()
+
+    stages = {}
+    with TemporaryDirectory() as directory:
+        bench_export(stages, args, directory)
+    if not args.skip_ia:
+        bench_ia(stages, args)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        dump({
+            'parameters': {
+                key: value for key, value in vars(args).items()
+                if key not in ('output', 'compare')
+            },
+            'stages': stages,
+        }, f, ensure_ascii=False, indent=2)
+    print(f'Результаты сохранены в {args.output}')
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(stages, load(f)['stages'])
@@ -0,0 +1,51 @@
+from argparse import ArgumentParser
+from os import getcwd
+from os.path import join
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from main import read_config, save_to_pg
+
+
+def make_frame(rows):
+    rng = np.random.default_rng(0)
+    # Даты -- строки ISO, как их возвращает чтение из базы: save_to_pg
+    # сам разбирает столбец date
+    dates = pd.Timestamp('2023-01-01', tz='Europe/Moscow') \
+        + pd.to_timedelta(rng.integers(0, 10 ** 6, rows), unit='s')
+    return pd.DataFrame({
+        'id': np.arange(rows),
+        'amount': rng.random(rows),
+        'code': rng.integers(0, 1000, rows).astype(str),
+        'date': dates.strftime('%Y-%m-%dT%H:%M:%S.123000+03:00'),
+    })
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Сравнение скорости загрузки save_to_pg: '
+                    'multi-INSERT против COPY.'
+    )
+    parser.add_argument('-c', '--config', required=False,
+                        default=join(getcwd(), 'config.yml'))
+    parser.add_argument('-r', '--rows', required=False, type=int,
+                        default=100000)
+
+    args = parser.parse_args()
+
+    output_db = read_config(args.config)['output_db']
+    df = make_frame(args.rows)
+
+    for method in ['multi', 'copy']:
+        start = perf_counter()
+        save_to_pg(
+            {**output_db, 'method': method},
+            df,
+            f"{output_db['table']}_bench",
+            'replace'
+        )
+        elapsed = perf_counter() - start
+        print(f'{method}: {args.rows / elapsed:.0f} строк/с '
+              f'({elapsed:.2f} с)')
@@ -0,0 +1,64 @@
+from argparse import ArgumentParser
+from json import dump
+from os.path import exists, join
+from statistics import median
+from subprocess import DEVNULL, run
+from sys import executable
+from time import perf_counter
+
+DIST_DIRPATH = join('dist', 'linux')
+
+# Собранные distrib.sh бинарники и те же скрипты из исходников
+COMMANDS = {
+    'postgre_to_csv': [join(DIST_DIRPATH, 'postgre_to_csv'), '--help'],
+    'get_imz_wip': [join(DIST_DIRPATH, 'get_imz_wip'), '--help'],
+    'batch_export': [join(DIST_DIRPATH, 'batch_export'), '--help'],
+    'main.py': [executable, 'main.py', '--help'],
+    'main_wip_imz.py': [executable, 'main_wip_imz.py', '--help'],
+    'main_mssql.py': [executable, 'main_mssql.py', '--help'],
+    'batch.py': [executable, 'batch.py', '--help'],
+    # Для сравнения: сколько стоит сам импорт pandas и SQLAlchemy
+    'import pandas, sqlalchemy': [
+        executable, '-c', 'import pandas, sqlalchemy'
+    ],
+}
+
+
+def measure(command, repeat):
+    # Первый запуск прогревает файловый кэш и не учитывается
+    run(command, stdout=DEVNULL, stderr=DEVNULL, check=True)
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        run(command, stdout=DEVNULL, stderr=DEVNULL, check=True)
+        timings.append(perf_counter() - start)
+    return {
+        'min': round(min(timings), 3),
+        'median': round(median(timings), 3),
+        'max': round(max(timings), 3),
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Время запуска (--help) собранных бинарников и '
+                    'скриптов. Бинарники, которых нет в dist/linux, '
+                    'пропускаются.'
+    )
+    parser.add_argument('-r', '--repeat', required=False, type=int,
+                        default=5)
+    parser.add_argument('-o', '--output', required=False,
+                        default='bench_startup.json')
+
+    args = parser.parse_args()
+
+    results = {}
+    for name, command in COMMANDS.items():
+        if command[0] != executable and not exists(command[0]):
+            continue
+        results[name] = measure(command, args.repeat)
+        print(f'{name}: медиана {results[name]["median"]:.2f} с, '
+              f'минимум {results[name]["min"]:.2f} с')
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        dump(results, f, ensure_ascii=False, indent=2)
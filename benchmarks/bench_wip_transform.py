@@ -0,0 +1,126 @@
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from pandas.testing import assert_frame_equal
+
+from main_wip_imz import transform_wip
+
+
+class StubIA(object):
+
+    def __init__(self, phases, entities):
+        self._phases = phases
+        self._entities = entities
+
+    def get_first_phase_operation(self, phase_identity):
+        if phase_identity not in self._phases:
+            return None
+        return f'{phase_identity}_1'
+
+    def get_last_phase_operation(self, phase_identity):
+        if phase_identity not in self._phases:
+            return None
+        return f'{phase_identity}_9'
+
+    def get_entity_id(self, entity_identity):
+        return self._entities.get(entity_identity)
+
+    def get_entity_first_phase(self, entity_id):
+        if entity_id is None:
+            return None
+        if entity_id % 7 == 0:
+            raise KeyError(entity_id)
+        return f'PH{entity_id % 50}'
+
+
+def legacy_transform_wip(result, ia):
+    final_result = []
+    for row in result.iterrows():
+        if 'VPSK' in row[1]['operation_id']:
+            row[1]['operation_id'] = ''
+            row[1]['operation_progress'] = 100
+            row[1]['batch_id'] = f"{row[1]['batch_id']}_done"
+        if row[1]['#operation_name'] == 'ERP_FINISHED':
+            row[1]['operation_id'] = ia.get_last_phase_operation(
+                row[1]['#route_phase']
+            )
+            row[1]['operation_progress'] = 100
+            try:
+                if row[1]['#route_phase'] == ia.get_entity_first_phase(
+                        ia.get_entity_id(row[1]['code'])
+                ):
+                    row[1]['PROVIDED'] = 1
+            except KeyError:
+                pass
+        if row[1]['#operation_name'] == 'STOCK':
+            row[1]['operation_id'] = ia.get_first_phase_operation(
+                row[1]['#route_phase']
+            )
+            try:
+                if row[1]['#route_phase'] == ia.get_entity_first_phase(
+                        ia.get_entity_id(row[1]['code'])
+                ):
+                    row[1]['PROVIDED'] = 1
+            except KeyError:
+                pass
+
+        if row[1]['amount'] > 0:
+            final_result.append(row[1])
+    final_result = [
+        {k.upper(): v for k, v in row.items()}
+        for row in final_result
+    ]
+    return DataFrame(final_result)
+
+
+def make_wip(rows):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'batch_id': rng.integers(0, 10 ** 6, rows).astype(str),
+        'code': np.char.add('E', rng.integers(0, 1000, rows).astype(str)),
+        'operation_id': np.where(
+            rng.random(rows) < 0.1,
+            'VPSK_1',
+            np.char.add('OP', rng.integers(0, 10 ** 4, rows).astype(str))
+        ),
+        '#operation_name': rng.choice(
+            ['ERP_FINISHED', 'STOCK', 'WORK'], rows
+        ),
+        '#route_phase': np.char.add(
+            'PH', rng.integers(0, 60, rows).astype(str)
+        ),
+        'operation_progress': rng.integers(0, 100, rows),
+        'amount': rng.integers(-2, 10, rows),
+    })
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Сравнение построчного и векторного разбора НЗП.'
+    )
+    parser.add_argument('-r', '--rows', required=False, type=int,
+                        default=100000)
+
+    args = parser.parse_args()
+
+    wip = make_wip(args.rows)
+    ia = StubIA(
+        {f'PH{i}' for i in range(55)},
+        {f'E{i}': i for i in range(900)}
+    )
+
+    start = perf_counter()
+    expected = legacy_transform_wip(wip, ia)
+    legacy_elapsed = perf_counter() - start
+
+    start = perf_counter()
+    actual = transform_wip(wip, ia)
+    elapsed = perf_counter() - start
+
+    assert_frame_equal(actual, expected)
+    print(f'iterrows: {legacy_elapsed:.2f} с, '
+          f'векторно: {elapsed:.2f} с, '
+          f'ускорение {legacy_elapsed / elapsed:.1f}x')
@@ -0,0 +1,55 @@
+from argparse import ArgumentParser
+from asyncio import gather, run
+from time import perf_counter
+
+from httpx import AsyncClient
+
+
+async def timed_get(client, url):
+    start = perf_counter()
+    response = await client.get(url)
+    await response.aread()
+    return response.status_code, perf_counter() - start
+
+
+async def load_test(base_url, slow, fast, slow_count, fast_count):
+    async with AsyncClient(base_url=base_url, timeout=None) as client:
+        start = perf_counter()
+        results = await gather(
+            *[timed_get(client, f'/ca/{slow}') for _ in range(slow_count)],
+            *[timed_get(client, f'/ca/{fast}') for _ in range(fast_count)],
+        )
+        elapsed = perf_counter() - start
+    slow_results = results[:slow_count]
+    fast_results = results[slow_count:]
+    for name, group in [(slow, slow_results), (fast, fast_results)]:
+        if not group:
+            continue
+        latencies = sorted(latency for _, latency in group)
+        statuses = sorted({status for status, _ in group})
+        print(f'{name}: {len(group)} запросов, статусы {statuses}, '
+              f'медиана {latencies[len(latencies) // 2]:.2f} с, '
+              f'максимум {latencies[-1]:.2f} с')
+    print(f'Всего: {len(results)} запросов за {elapsed:.2f} с '
+          f'({len(results) / elapsed:.1f} запросов/с)')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Нагрузочный тест web-server: медленные и быстрые '
+                    'выгрузки одновременно. Для проверки на локальном '
+                    'Postgres достаточно двух конфигов, например slow.yml '
+                    'с запросом "select pg_sleep(2)" и fast.yml с '
+                    '"select 1 as x".'
+    )
+    parser.add_argument('-u', '--url', required=False,
+                        default='http://127.0.0.1:8000')
+    parser.add_argument('--slow', required=False, default='slow')
+    parser.add_argument('--fast', required=False, default='fast')
+    parser.add_argument('--slow-count', required=False, type=int, default=8)
+    parser.add_argument('--fast-count', required=False, type=int, default=50)
+
+    args = parser.parse_args()
+
+    run(load_test(args.url, args.slow, args.fast,
+                  args.slow_count, args.fast_count))
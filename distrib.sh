@@ -1,5 +1,21 @@
 PROJECT_DIRPATH="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
 
+# --onefile распаковывает весь бинарник при каждом запуске; для частых
+# запусков быстрее собрать каталог: BUNDLE_MODE=--onedir ./distrib.sh
+BUNDLE_MODE="${BUNDLE_MODE:---onefile}"
+
+# SQLAlchemy и его диалект загружают эти модули динамически, поэтому
+# PyInstaller не находит их сам; ненужные пакеты в сборку не берём
+PYINSTALLER_OPTIONS="--clean \
+                     ${BUNDLE_MODE} \
+                     --hidden-import sqlalchemy.sql.default_comparator \
+                     --hidden-import psycopg2 \
+                     --exclude-module tkinter \
+                     --exclude-module matplotlib \
+                     --exclude-module IPython \
+                     --exclude-module pytest \
+                     --distpath=dist/linux/"
+
 docker run \
     --rm \
     --workdir='/usr/src/myapp' \
@@ -7,13 +23,12 @@ docker run \
     python:3.8 bash -c "pip3 install pyinstaller;
                                pip3 install -r requirements.txt;
                                pyinstaller main_wip_imz.py \
-                               --clean \
-                               --onefile \
-                               --name get_imz_wip \
-                               --distpath=dist/linux/ ;
+                               ${PYINSTALLER_OPTIONS} \
+                               --name get_imz_wip ;
                                pyinstaller main.py \
-                               --clean \
-                               --onefile \
-                               --name postgre_to_csv \
-                               --distpath=dist/linux/ ;
-                               chown -R ${UID} dist; "
\ No newline at end of file
+                               ${PYINSTALLER_OPTIONS} \
+                               --name postgre_to_csv ;
+                               pyinstaller batch.py \
+                               ${PYINSTALLER_OPTIONS} \
+                               --name batch_export ;
+                               chown -R ${UID} dist; "
@@ -0,0 +1,90 @@
+import sqlite3
+from json import dumps, loads
+from os import makedirs
+from os.path import join
+from threading import Lock
+from time import time
+
+from .base import Base
+
+__all__ = [
+    'CollectionCache',
+]
+
+
+class CollectionCache(Base):
+
+    def __init__(self, cache_dir, ttl=3600, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        makedirs(cache_dir, exist_ok=True)
+        self._ttl = ttl
+        self._lock = Lock()
+        self._connection = sqlite3.connect(
+            join(cache_dir, 'ia_cache.sqlite'),
+            check_same_thread=False
+        )
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS page ('
+                'base_url TEXT, '
+                'uri TEXT, '
+                'collection TEXT, '
+                'data TEXT, '
+                'etag TEXT, '
+                'last_modified TEXT, '
+                'fetched_at REAL, '
+                'PRIMARY KEY (base_url, uri))'
+            )
+
+    def get(self, base_url, uri):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT data, etag, last_modified, fetched_at '
+                'FROM page WHERE base_url = ? AND uri = ?',
+                (base_url, uri)
+            ).fetchone()
+        if row is None:
+            return None
+        data, etag, last_modified, fetched_at = row
+        return {
+            'data': loads(data),
+            'etag': etag,
+            'last_modified': last_modified,
+            'fresh': time() - fetched_at < self._ttl,
+        }
+
+    def put(self, base_url, collection, uri, data,
+            etag=None, last_modified=None):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO page VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (base_url, uri, collection, dumps(data),
+                 etag, last_modified, time())
+            )
+
+    def touch(self, base_url, uri):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE page SET fetched_at = ? '
+                'WHERE base_url = ? AND uri = ?',
+                (time(), base_url, uri)
+            )
+
+    def invalidate(self, base_url, collection=None):
+        self._logger.debug('Сброс кэша {!r} для {!r}.'.format(
+            collection or 'всех таблиц', base_url
+        ))
+        with self._lock, self._connection:
+            if collection is None:
+                self._connection.execute(
+                    'DELETE FROM page WHERE base_url = ?',
+                    (base_url,)
+                )
+            else:
+                self._connection.execute(
+                    'DELETE FROM page WHERE base_url = ? AND collection = ?',
+                    (base_url, collection)
+                )
+
+    def close(self):
+        self._connection.close()
@@ -1,13 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from functools import partialmethod
 from json import JSONDecodeError
+from threading import Lock
+from time import perf_counter, sleep
 from urllib.parse import urljoin
 
 from requests import Session
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
-from utils.list_to_dict import list_to_dict
 from .base import Base
+from .collection_cache import CollectionCache
+from .route_index import RouteIndex
 
 __all__ = [
     'IAImportExport',
@@ -18,22 +23,49 @@ _DATETIME_SIMPLE_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
 class IAImportExport(Base):
 
-    def __init__(self, login, password, base_url, *args, **kwargs):
+    def __init__(self, login, password, base_url, *args,
+                 cache_dir=None, cache_ttl=3600, concurrency=4,
+                 page_size=100000, retries=3, **kwargs):
         super().__init__(*args, **kwargs)
         self._base_url = base_url
         self._login = login
         self._password = password
+        self._concurrency = concurrency
+        self._page_size = page_size
+        self._retries = retries
 
         self._session = Session()
         self._session.verify = False
+        self._session.mount('http://', HTTPAdapter(pool_maxsize=concurrency))
+        self._session.mount('https://', HTTPAdapter(pool_maxsize=concurrency))
+        self._logged_in = False
+        self._login_lock = Lock()
 
         self.cache = {}
+        # таблица -> (секунд на получение, строк)
+        self.fetch_stats = {}
+        self._route_index = None
+
+        self._collection_cache = None
+        if cache_dir is not None:
+            self._collection_cache = CollectionCache(cache_dir, cache_ttl)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._session.close()
+        if self._collection_cache is not None:
+            self._collection_cache.close()
+
+    def invalidate_cache(self, table=None):
+        self._route_index = None
+        if table is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(table, None)
+        if self._collection_cache is not None:
+            self._collection_cache.invalidate(self._base_url, table)
 
     def _make_url(self, uri):
         return urljoin(self._base_url, uri)
@@ -45,43 +77,133 @@ class IAImportExport(Base):
             filename
         )
 
+    def _ensure_login(self):
+        with self._login_lock:
+            if not self._logged_in:
+                self._perform_login()
+                self._logged_in = True
+
+    def _get_page(self, table, uri):
+        cached = None
+        if self._collection_cache is not None:
+            cached = self._collection_cache.get(self._base_url, uri)
+            if cached is not None and cached['fresh']:
+                return cached['data']
+
+        self._ensure_login()
+
+        # Если сервер отдаёт ETag или Last-Modified, устаревшая страница
+        # перепроверяется условным запросом и скачивается заново только
+        # при изменении данных
+        headers = {}
+        if cached is not None:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        response = self._perform_request('GET', uri, headers=headers)
+        if cached is not None and response.status_code == 304:
+            self._collection_cache.touch(self._base_url, uri)
+            return cached['data']
+        response.raise_for_status()
+
+        data = self._decode_json(response, 'GET', self._make_url(uri))
+        # В кэш попадают только успешные ответы со строками коллекции, а не
+        # ошибки сервера (503 с JSON в теле и т.п.)
+        if self._collection_cache is not None and response.ok \
+                and table in data:
+            self._collection_cache.put(
+                self._base_url,
+                table,
+                uri,
+                data,
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified')
+            )
+        return data
+
+    def _get_page_with_retry(self, table, uri, start=0):
+        for attempt in range(self._retries):
+            try:
+                data = self._get_page(table, uri)
+                # Страница внутри коллекции без строк -- сбой сервера, а не
+                # конец данных: её нужно запросить снова
+                if table not in data and data['meta']['count'] > start:
+                    raise ValueError(
+                        'В ответе {!r} нет строк {}'.format(uri, table)
+                    )
+                return data
+            except Exception as e:
+                if attempt + 1 == self._retries:
+                    raise
+                self._logger.warning(
+                    'Ошибка при получении {!r}: {!r}, '
+                    'повтор {} из {}.'.format(
+                        uri, e, attempt + 1, self._retries - 1
+                    )
+                )
+                sleep(2 ** attempt)
+
     def _get_from_rest_collection(self, table):
         if table not in self.cache:
-            self.cache[table] = []
-            self._perform_login()
-            counter = 0
-            step = 100000
+            self._logged_in = False
+            step = self._page_size
             if table == 'specification_item':
                 order_by = '&order_by=parent_id&order_by=child_id'
             elif table == 'operation_profession':
                 order_by = '&order_by=operation_id&order_by=profession_id'
             else:
                 order_by = '&order_by=id'
-            pbar = tqdm(desc=f'Получение данных из таблицы {table}')
-            while True:
-                temp = self._perform_get(
+
+            def make_uri(start):
+                return (
                     f'rest/collection/{table}'
-                    f'?start={counter}'
-                    f'&stop={counter + step}'
+                    f'?start={start}'
+                    f'&stop={start + step}'
                     f'{order_by}'
                 )
-                pbar.total = temp['meta']['count']
-                counter += step
-                pbar.update(min(
-                    step,
-                    temp['meta']['count'] - (counter - step)
-                ))
-                if table not in temp:
-                    break
-                self.cache[table] += temp[table]
-                if counter >= temp['meta']['count']:
-                    break
+
+            # Первая страница сообщает общее число строк, после чего
+            # остальные окна запрашиваются параллельно
+            fetch_start = perf_counter()
+            first_page = self._get_page_with_retry(table, make_uri(0))
+            count = first_page['meta']['count']
+            pages = {0: first_page}
+            with tqdm(total=count,
+                      desc=f'Получение данных из таблицы {table}') as pbar:
+                pbar.update(min(step, count))
+                if step < count:
+                    with ThreadPoolExecutor(self._concurrency) as executor:
+                        futures = {
+                            executor.submit(
+                                self._get_page_with_retry,
+                                table,
+                                make_uri(start),
+                                start
+                            ): start
+                            for start in range(step, count, step)
+                        }
+                        for future in as_completed(futures):
+                            start = futures[future]
+                            pages[start] = future.result()
+                            pbar.update(min(step, count - start))
+            # Коллекция попадает в кэш только целиком: если страница так и
+            # не получена, исключение уходит вызывающему
+            rows = []
+            for start in sorted(pages):
+                rows += pages[start].get(table, [])
+            self.cache[table] = rows
+            self.fetch_stats[table] = (
+                perf_counter() - fetch_start,
+                len(self.cache[table])
+            )
         return self.cache[table]
 
     def _get_main_session(self):
         return self._perform_get('action/primary_simulation_session')['data']
 
-    def _perform_json_request(self, http_method, uri, **kwargs):
+    def _perform_request(self, http_method, uri, **kwargs):
         url = self._make_url(uri)
         logger = self._logger
 
@@ -90,9 +212,16 @@ class IAImportExport(Base):
 
         logger.debug('Отправляемые данные: {!r}.'.format(kwargs))
 
-        response = self._session.request(http_method,
-                                         url=url,
-                                         **kwargs)
+        return self._session.request(http_method,
+                                     url=url,
+                                     **kwargs)
+
+    def _perform_json_request(self, http_method, uri, **kwargs):
+        response = self._perform_request(http_method, uri, **kwargs)
+        return self._decode_json(response, http_method, self._make_url(uri))
+
+    def _decode_json(self, response, http_method, url):
+        logger = self._logger
         try:
             response_json = response.json()
         except JSONDecodeError:
@@ -128,219 +257,49 @@ class IAImportExport(Base):
             action='login'
         )['data']
 
-    def get_phase_with_operation_id(self, operation_id):
-
-        if 'phase_identity' in self.cache:
-            return self.cache['phase_identity'].get(operation_id)
-
-        self.cache['phase_identity'] = {}
-
-        entity_routes_dict = list_to_dict(
-            self._get_from_rest_collection('entity_route')
-        )
-
-        operation_dict = list_to_dict(sorted(
-            self._get_from_rest_collection('operation'),
-            key=lambda k: k['nop']
-        ))
-
-        entity_routes_phases_dict = list_to_dict(
-            self._get_from_rest_collection('entity_route_phase')
-        )
-
-        for op_id, operation in operation_dict.items():
-            if operation['entity_route_phase_id'] is None:
-                if '(' not in operation['identity']:
-                    tqdm.write(f'Не найдена фаза для '
-                               f'операции {operation["identity"]}')
-                continue
-            self.cache['phase_identity'][op_id] = entity_routes_phases_dict[
-                    operation['entity_route_phase_id']
-                ]['identity']
+    def _get_route_index(self):
+        if self._route_index is None:
+            self._route_index = RouteIndex(
+                self._get_from_rest_collection('operation'),
+                self._get_from_rest_collection('entity_route_phase'),
+                self._get_from_rest_collection('entity_route'),
+            )
+        return self._route_index
 
-        return self.cache['phase_identity'].get(operation_id)
+    def get_phase_with_operation_id(self, operation_id):
+        return self._get_route_index().operation_phase.get(operation_id)
 
     def get_first_phase_operation(self, phase_identity):
-
-        if 'first_operation_identity' in self.cache:
-            if phase_identity not in self.cache['first_operation_identity']:
-                tqdm.write(f'Не нашли первую операцию '
-                           f'маршрута для {phase_identity}')
-                print(self.cache['first_operation_identity'])
-            return self.cache['first_operation_identity'].get(phase_identity)
-
-        self.cache['first_operation_identity'] = {}
-
-        operation_dict = list_to_dict(sorted(
-            self._get_from_rest_collection('operation'),
-            key=lambda k: k['nop']
-        ))
-
-        entity_routes_phases_dict = list_to_dict(
-            self._get_from_rest_collection('entity_route_phase')
+        operation = self._get_route_index().get_first_phase_operation(
+            phase_identity
         )
-
-        for op_id, operation in operation_dict.items():
-            if operation['entity_route_phase_id'] is None:
-                if '(' not in operation['identity']:
-                    tqdm.write(f'Не найдена фаза для '
-                               f'операции {operation["identity"]}')
-                continue
-            cur_phase_identity = entity_routes_phases_dict[
-                operation['entity_route_phase_id']
-            ]['identity']
-            if cur_phase_identity not in self.cache['first_operation_identity']:
-                self.cache['first_operation_identity'][cur_phase_identity] = \
-                    f"{cur_phase_identity}_{operation['nop']}"
-            if f"{cur_phase_identity}_{operation['nop']}" < \
-                    self.cache['first_operation_identity'][cur_phase_identity]:
-                self.cache['first_operation_identity'][
-                    cur_phase_identity
-                ] = f"{cur_phase_identity}_{operation['nop']}"
-
-        return self.cache['first_operation_identity'].get(phase_identity)
+        if operation is None:
+            tqdm.write(f'Не нашли первую операцию '
+                       f'маршрута для {phase_identity}')
+        return operation
 
     def get_last_phase_operation(self, phase_identity):
-
-        if 'last_operation_identity' in self.cache:
-            if phase_identity not in self.cache['last_operation_identity']:
-                tqdm.write(f'Не нашли последнюю операцию '
-                           f'маршрута для {phase_identity}')
-                print(self.cache['last_operation_identity'])
-            return self.cache['last_operation_identity'].get(phase_identity)
-
-        self.cache['last_operation_identity'] = {}
-
-        operation_dict = list_to_dict(sorted(
-            self._get_from_rest_collection('operation'),
-            key=lambda k: k['nop']
-        ))
-
-        entity_routes_phases_dict = list_to_dict(
-            self._get_from_rest_collection('entity_route_phase')
+        operation = self._get_route_index().get_last_phase_operation(
+            phase_identity
         )
-
-        for op_id, operation in operation_dict.items():
-            if operation['entity_route_phase_id'] is None:
-                if '(' not in operation['identity']:
-                    tqdm.write(f'Не найдена фаза для '
-                               f'операции {operation["identity"]}')
-                continue
-            cur_phase_identity = entity_routes_phases_dict[
-                operation['entity_route_phase_id']
-            ]['identity']
-            if cur_phase_identity not in self.cache['last_operation_identity']:
-                self.cache['last_operation_identity'][cur_phase_identity] = \
-                    f"{cur_phase_identity}_{operation['nop']}"
-            if f"{cur_phase_identity}_{operation['nop']}" > \
-                    self.cache['last_operation_identity'][cur_phase_identity]:
-                self.cache['last_operation_identity'][
-                    cur_phase_identity
-                ] = f"{cur_phase_identity}_{operation['nop']}"
-
-        return self.cache['last_operation_identity'].get(phase_identity)
+        if operation is None:
+            tqdm.write(f'Не нашли последнюю операцию '
+                       f'маршрута для {phase_identity}')
+        return operation
 
     def get_entity_last_phase(self, entity_id):
-        if 'main_routes' not in self.cache:
-            entity_routes = self._get_from_rest_collection(
-                'entity_route'
-            )
-            self.cache['main_routes'] = {
-                entity_route['entity_id']: entity_route
-                for entity_route in filter(
-                    lambda x: x['alternate'] is False,
-                    entity_routes
-                )
-            }
-
-        main_routes = self.cache['main_routes']
-
-        if entity_id not in main_routes:
-            return None
-
-        entity_route_id = main_routes[entity_id]['id']
-
-        if 'last_operations_entity_route_id' not in self.cache:
-
-            operations = sorted(
-                self._get_from_rest_collection('operation'),
-                key=lambda x: x['nop']
-            )
-
-            self.cache['last_operations_entity_route_id'] = {}
-            for row in operations:
-                self.cache[
-                    'last_operations_entity_route_id'
-                ][row['entity_route_id']] = row
-
-        last_operations_entity_route_id = self.cache[
-            'last_operations_entity_route_id'
-        ]
-
-        try:
-            operation = last_operations_entity_route_id[entity_route_id]
-        except IndexError:
-            return None
-
-        return self.get_phase_with_operation_id(operation['id'])
+        return self._get_route_index().get_entity_last_phase(entity_id)
 
     def get_entity_first_phase(self, entity_id):
-        if 'main_routes' not in self.cache:
-            entity_routes = self._get_from_rest_collection(
-                'entity_route'
-            )
-            self.cache['main_routes'] = {
-                entity_route['entity_id']: entity_route
-                for entity_route in filter(
-                    lambda x: x['alternate'] is False,
-                    entity_routes
-                )
-            }
-
-        main_routes = self.cache['main_routes']
-
-        if entity_id not in main_routes:
-            return None
-
-        entity_route_id = main_routes[entity_id]['id']
-
-        if 'first_operations_entity_route_id' not in self.cache:
-
-            operations = sorted(
-                self._get_from_rest_collection('operation'),
-                key=lambda x: x['nop'],
-                reverse=True
-            )
-
-            self.cache['first_operations_entity_route_id'] = {}
-            for row in operations:
-                self.cache[
-                    'first_operations_entity_route_id'
-                ][row['entity_route_id']] = row
-
-        first_operations_entity_route_id = self.cache[
-            'first_operations_entity_route_id'
-        ]
-
-        try:
-            operation = first_operations_entity_route_id[entity_route_id]
-        except IndexError:
-            return None
-
-        return self.get_phase_with_operation_id(operation['id'])
+        return self._get_route_index().get_entity_first_phase(entity_id)
 
     def get_entity_id(self, entity_identity):
-        if 'entity_id' not in self.cache:
-            self.cache['entity_id'] = {}
-        else:
-            return self.cache['entity_id'].get(entity_identity)
-        entities_dict = list_to_dict(
-            self._get_from_rest_collection('entity')
-        )
-        for entity_id, row in entities_dict.items():
-            self.cache['entity_id'][row['identity']] = entity_id
-
-        return self.cache['entity_id'].get(entity_identity)
+        route_index = self._get_route_index()
+        if route_index.entity_id is None:
+            route_index.index_entities(
+                self._get_from_rest_collection('entity')
+            )
+        return route_index.entity_id.get(entity_identity)
 
     @classmethod
     def from_config(cls, config):
@@ -348,4 +307,9 @@ class IAImportExport(Base):
             config['login'],
             config['password'],
             config['url'],
+            cache_dir=config.get('cache_dir'),
+            cache_ttl=config.get('cache_ttl', 3600),
+            concurrency=config.get('concurrency', 4),
+            page_size=config.get('page_size', 100000),
+            retries=config.get('retries', 3),
         )
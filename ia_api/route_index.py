@@ -0,0 +1,122 @@
+from sys import intern
+
+from tqdm import tqdm
+
+__all__ = [
+    'RouteIndex',
+]
+
+
+class _PhaseOperations(object):
+    __slots__ = ('first', 'last')
+
+    def __init__(self, identity):
+        self.first = identity
+        self.last = identity
+
+
+class _RouteOperations(object):
+    __slots__ = ('first_nop', 'first_id', 'last_nop', 'last_id')
+
+    def __init__(self, nop, operation_id):
+        self.first_nop = self.last_nop = nop
+        self.first_id = self.last_id = operation_id
+
+
+class RouteIndex(object):
+    __slots__ = (
+        'operation_phase',
+        'phase_operations',
+        'route_operations',
+        'main_routes',
+        'entity_id',
+    )
+
+    def __init__(self, operations, entity_route_phases, entity_routes):
+        phase_identity = {
+            phase['id']: intern(phase['identity'])
+            for phase in entity_route_phases
+        }
+
+        # операция -> идентификатор её фазы
+        self.operation_phase = {}
+        # идентификатор фазы -> первая и последняя операции фазы
+        self.phase_operations = {}
+        # маршрут -> операции с минимальным и максимальным nop
+        self.route_operations = {}
+
+        for operation in operations:
+            nop = operation['nop']
+            route_id = operation['entity_route_id']
+            route = self.route_operations.get(route_id)
+            if route is None:
+                self.route_operations[route_id] = _RouteOperations(
+                    nop, operation['id']
+                )
+            else:
+                # При равных nop побеждает последняя по порядку операция --
+                # так же, как при устойчивой сортировке
+                if nop <= route.first_nop:
+                    route.first_nop = nop
+                    route.first_id = operation['id']
+                if nop >= route.last_nop:
+                    route.last_nop = nop
+                    route.last_id = operation['id']
+
+            if operation['entity_route_phase_id'] is None:
+                if '(' not in operation['identity']:
+                    tqdm.write(f'Не найдена фаза для '
+                               f'операции {operation["identity"]}')
+                continue
+            phase = phase_identity[operation['entity_route_phase_id']]
+            self.operation_phase[operation['id']] = phase
+
+            # Операции фазы сравниваются как строки, как и раньше
+            identity = f'{phase}_{nop}'
+            phase_operations = self.phase_operations.get(phase)
+            if phase_operations is None:
+                self.phase_operations[phase] = _PhaseOperations(identity)
+            elif identity < phase_operations.first:
+                phase_operations.first = identity
+            elif identity > phase_operations.last:
+                phase_operations.last = identity
+
+        # сущность -> основной (не альтернативный) маршрут
+        self.main_routes = {
+            entity_route['entity_id']: entity_route['id']
+            for entity_route in entity_routes
+            if entity_route['alternate'] is False
+        }
+
+        # идентификатор сущности -> id, заполняется отдельно
+        self.entity_id = None
+
+    def index_entities(self, entities):
+        self.entity_id = {
+            intern(entity['identity']): entity['id']
+            for entity in entities
+        }
+
+    def get_first_phase_operation(self, phase_identity):
+        phase_operations = self.phase_operations.get(phase_identity)
+        if phase_operations is None:
+            return None
+        return phase_operations.first
+
+    def get_last_phase_operation(self, phase_identity):
+        phase_operations = self.phase_operations.get(phase_identity)
+        if phase_operations is None:
+            return None
+        return phase_operations.last
+
+    def get_entity_first_phase(self, entity_id):
+        if entity_id not in self.main_routes:
+            return None
+        route = self.route_operations[self.main_routes[entity_id]]
+        return self.operation_phase.get(route.first_id)
+
+    def get_entity_last_phase(self, entity_id):
+        if entity_id not in self.main_routes:
+            return None
+        route = self.route_operations[self.main_routes[entity_id]]
+        return self.operation_phase.get(route.last_id)
@@ -1,76 +1,368 @@
 from argparse import ArgumentParser
+from io import StringIO
 from logging import basicConfig, DEBUG, INFO
+from multiprocessing import freeze_support
 from os import getcwd
 from os.path import join
+from time import perf_counter
 
-import pandas as pd
-from sqlalchemy import create_engine
-from tqdm import tqdm
-from yaml import SafeLoader, load
-import sqlalchemy.sql.default_comparator
-import psycopg2
-
+from utils.config import read_config, render_query, use_chunks
+from utils.metrics import log_to_file, observe, profiled, stage
 from version import version_description
 
+# pandas, SQLAlchemy и модули utils, которые их тянут, импортируются в
+# функциях, которым они нужны: --help и режим pipeline запускаются без
+# pandas, а каждый запуск собранного бинарника не платит за лишнее
 
-def read_config(config_filepath):
-    with open(config_filepath, 'r', encoding="utf-8") as f:
-        return load(f, Loader=SafeLoader)
 
+DATE_COLUMNS = ['date', 'start_date', 'stop_date', 'date_from', 'date_to']
 
-def script(db_config, query):
-    engine = create_engine('postgresql://{}:{}@{}:{}/{}'.format(
-        db_config['database_login'],
-        db_config['database_password'],
-        db_config['database_server'],
-        db_config['database_port'],
-        db_config['database']
-    ))
 
-    result = pd.read_sql(
-        query,
-        engine
-    )
+def script(db_config, query, params=None, partition=None):
+    import pandas as pd
+    from utils.engines import connect
+    from utils.partitions import read_partitioned
+
+    if partition:
+        return read_partitioned(db_config, query, params, partition)
+
+    with connect(db_config) as connection:
+        result = pd.read_sql(
+            query,
+            connection,
+            params=params
+        )
 
     return result
 
 
-def save_to_pg(db_config, df, name, replace):
-    def chunker(seq, size):
-        return (seq[pos:pos + size] for pos in range(0, len(seq), size))
+def script_chunks(db_config, query, chunksize, params=None):
+    import pandas as pd
+    from utils.engines import connect
+
+    # stream_results заставляет psycopg2 использовать именованный
+    # (серверный) курсор, так что в памяти держится только одна порция
+    with connect(db_config, stream_results=True) as connection:
+        offset = 0
+        start = perf_counter()
+        for chunk in pd.read_sql(query, connection, params=params,
+                                 chunksize=chunksize):
+            observe('read', perf_counter() - start, len(chunk))
+            chunk.index += offset
+            offset += len(chunk)
+            yield chunk
+            start = perf_counter()
+
+
+def make_writer(config, streaming=False):
+    from utils.writers import ParallelWriter
+
+    return ParallelWriter(
+        config['output_file'],
+        config.get('output_formats'),
+        streaming=streaming,
+        parallel=config.get('parallel_writers', True),
+        options={
+            extension: config[extension]
+            for extension in ['csv', 'json', 'xlsx', 'parquet', 'arrow',
+                              'feather']
+            if extension in config
+        }
+    )
+
+
+def export_chunks(config, query, params=None, watermark=None):
+    from tqdm import tqdm
+    from utils.watermarks import get_max_watermark
+
+    writer = make_writer(config, streaming=True)
+    incremental = config.get('incremental', {})
+    if 'output_db' in config:
+        replace = config['output_db']['replace']
+    try:
+        with tqdm(desc='Выгрузка по частям', unit=' строк') as pbar:
+            for chunk in script_chunks(config['db'], query,
+                                       config['chunksize'], params):
+                if 'output_db' in config:
+                    save_to_pg(
+                        config['output_db'],
+                        chunk,
+                        config['output_db']['table'],
+                        replace,
+                        incremental.get('key'),
+                    )
+                    replace = 'append'
+                writer.write(chunk)
+                if incremental:
+                    watermark = get_max_watermark(
+                        chunk, incremental['column'], watermark
+                    )
+                pbar.update(len(chunk))
+    finally:
+        writer.close()
+    return watermark
+
+
+def chunker(seq, size):
+    return (seq[pos:pos + size] for pos in range(0, len(seq), size))
+
+
+def quote_identifier(name):
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+def integral_floats_as_int(df):
+    # Целые столбцы с пропусками приходят из pandas как float64, и to_csv
+    # пишет 5.0, которое COPY в bigint не принимает (INSERT приводил его
+    # сам). Такие столбцы без дробных частей передаются как Int64
+    columns = {}
+    for i, dtype in enumerate(df.dtypes):
+        if dtype.kind != 'f':
+            continue
+        values = df.iloc[:, i].dropna()
+        if values.empty or (values == values.round()).all() \
+                and values.abs().max() < 2 ** 63:
+            columns[i] = 'Int64'
+    if not columns:
+        return df
+    df = df.copy(deep=False)
+    for i, dtype in columns.items():
+        df.isetitem(i, df.iloc[:, i].astype(dtype))
+    return df
+
+
+def copy_rows(cursor, df, name, chunksize):
+    from tqdm import tqdm
+
+    columns = ', '.join(quote_identifier(column) for column in df.columns)
+    copy_sql = (
+        f'COPY {quote_identifier(name)} ({columns}) '
+        f"FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    )
+    with tqdm(total=len(df), desc=name) as pbar:
+        for cdf in chunker(df, chunksize):
+            buffer = StringIO()
+            integral_floats_as_int(cdf).to_csv(buffer, index=False,
+                                               header=False, na_rep='\\N')
+            buffer.seek(0)
+            cursor.copy_expert(copy_sql, buffer)
+            pbar.update(len(cdf))
+
+
+def copy_to_pg(db_config, df, name, replace, chunksize, dtype=None):
+    from utils.engines import begin
+
+    # Создание таблицы и все COPY идут в одной транзакции: при ошибке
+    # целевая таблица остаётся в прежнем состоянии
+    with begin(db_config) as connection:
+        df.head(0).to_sql(
+            name,
+            connection,
+            if_exists=replace,
+            index=False,
+            dtype=dtype
+        )
+        cursor = connection.connection.cursor()
+        copy_rows(cursor, df, name, chunksize)
+        cursor.close()
+
+
+def upsert_to_pg(db_config, df, name, key, chunksize, dtype=None):
+    from sqlalchemy import inspect, text
+    from utils.engines import begin
+    from utils.watermarks import check_upsert_key
+
+    # key: id в YAML -- строка, а не список столбцов
+    key = [key] if isinstance(key, str) else list(key)
+    columns = [quote_identifier(column) for column in df.columns]
+    keys = [quote_identifier(column) for column in key]
+    updates = [
+        f'{column} = excluded.{column}'
+        for column in columns if column not in keys
+    ]
+    delta = f'{name}_delta'
+    with begin(db_config) as connection:
+        if not inspect(connection).has_table(name):
+            df.head(0).to_sql(name, connection, index=False, dtype=dtype)
+            connection.execute(text(
+                f'ALTER TABLE {quote_identifier(name)} '
+                f'ADD PRIMARY KEY ({", ".join(keys)})'
+            ))
+        else:
+            check_upsert_key(connection, name, key)
+        # Новые строки сначала копируются во временную таблицу, а затем
+        # одним INSERT ... ON CONFLICT вливаются в целевую
+        connection.execute(text(
+            f'CREATE TEMP TABLE {quote_identifier(delta)} '
+            f'(LIKE {quote_identifier(name)} INCLUDING DEFAULTS) '
+            f'ON COMMIT DROP'
+        ))
+        cursor = connection.connection.cursor()
+        copy_rows(cursor, df, delta, chunksize)
+        cursor.close()
+        connection.execute(text(
+            f'INSERT INTO {quote_identifier(name)} ({", ".join(columns)}) '
+            f'SELECT {", ".join(columns)} FROM {quote_identifier(delta)} '
+            f'ON CONFLICT ({", ".join(keys)}) DO ' + (
+                f'UPDATE SET {", ".join(updates)}' if updates else 'NOTHING'
+            )
+        ))
+
+
+def insert_to_pg(db_config, df, name, replace, chunksize, dtype=None):
+    from tqdm import tqdm
+    from utils.engines import begin
 
-    engine = create_engine('postgresql://{}:{}@{}:{}/{}'.format(
-        db_config['database_login'],
-        db_config['database_password'],
-        db_config['database_server'],
-        db_config['database_port'],
-        db_config['database']
-    ))
-    print('Database session created')
-    chunksize = 100
-    df = pd.DataFrame(df)
-    for column in ['date', 'start_date', 'stop_date',
-                   'date_from', 'date_to']:
-        try:
-            df[column] = pd.to_datetime(
-                df[column].str[:19] + df[column].str[-6:],
-                format='%Y-%m-%dT%H:%M:%S%z')
-        except KeyError:
-            pass
     with tqdm(total=len(df), desc=name) as pbar:
         for i, cdf in enumerate(chunker(df, chunksize)):
             replace = replace if i == 0 else "append"
-            cdf.to_sql(
-                name,
-                engine,
-                if_exists=replace,
-                index=False,
-                method='multi'
-            )
+            with begin(db_config) as connection:
+                cdf.to_sql(
+                    name,
+                    connection,
+                    if_exists=replace,
+                    index=False,
+                    method='multi',
+                    dtype=dtype
+                )
             pbar.update(chunksize)
 
 
+def save_to_pg(db_config, df, name, replace, key=None):
+    import pandas as pd
+    from sqlalchemy.types import TIMESTAMP
+    from utils.dates import parse_iso_dates, resolve_date_columns
+
+    method = db_config.get('method', 'copy')
+    chunksize = db_config.get(
+        'chunksize',
+        100000 if method == 'copy' else 100
+    )
+    df = pd.DataFrame(df)
+    date_columns = resolve_date_columns(
+        df,
+        db_config.get('date_columns', DATE_COLUMNS)
+    )
+    # date_parsing: db -- строки передаются как есть в столбцы timestamptz,
+    # и разбирает их сам Postgres (с сохранением долей секунды)
+    dtype = {}
+    if db_config.get('date_parsing', 'pandas') == 'db':
+        dtype = {column: TIMESTAMP(timezone=True) for column in date_columns}
+    else:
+        with stage('dates', rows=len(df)):
+            for column in date_columns:
+                df[column] = parse_iso_dates(df[column])
+    with stage('load', rows=len(df), table=name, method=method):
+        if key:
+            upsert_to_pg(db_config, df, name, key, chunksize, dtype)
+        elif method == 'copy':
+            copy_to_pg(db_config, df, name, replace, chunksize, dtype)
+        else:
+            insert_to_pg(db_config, df, name, replace, chunksize, dtype)
+
+
+def run(config, raw_params=''):
+    if raw_params:
+        query, params = render_query(config, raw_params.split(','))
+    else:
+        query, params = config['query'], None
+    state_db = config.get('output_db')
+
+    # В инкрементальном режиме выбираются только строки новее сохранённой
+    # отметки, а в output_db они вливаются по ключу
+    incremental = config.get('incremental', {})
+    watermark = None
+    if incremental:
+        from tqdm import tqdm
+        from utils.watermarks import (
+            get_max_watermark,
+            incremental_query,
+            merge_watermark,
+            read_watermark,
+            write_watermark,
+        )
+
+        state_name = incremental.get(
+            'name',
+            config.get('output_db', {}).get('table', config['output_file'])
+        )
+        watermark = read_watermark(incremental, state_name, state_db)
+        inclusive = bool(incremental.get('key'))
+        tqdm.write(f'Выгружаем строки с {incremental["column"]} '
+                   f'{">=" if inclusive else ">"} {watermark}')
+        query, params = incremental_query(
+            query, params, incremental['column'], watermark, inclusive
+        )
+        # Новые строки дописываются к выгруженным раньше: replace удалил бы
+        # таблицу вместе с ними. Конфиг копируется -- read_config его кэширует
+        if 'output_db' in config \
+                and config['output_db'].get('replace') != 'append':
+            tqdm.write('incremental: output_db.replace не учитывается, '
+                       'строки дописываются в таблицу')
+            config = {
+                **config,
+                'output_db': {**config['output_db'], 'replace': 'append'},
+            }
+
+    # В режиме pipeline таблица переливается из базы в базу через COPY без
+    # pandas, поэтому файлы output_file в нём не выгружаются
+    if config.get('output_db', {}).get('pipeline'):
+        from tqdm import tqdm
+        from utils.pg_pipeline import transfer_pg
+
+        date_columns = config['output_db'].get('date_columns', DATE_COLUMNS)
+        with stage('pipeline') as pipeline:
+            pipeline.rows, max_watermark = transfer_pg(
+                config['db'], config['output_db'], query, params,
+                [] if date_columns == 'auto' else date_columns,
+                incremental.get('key'), incremental.get('column')
+            )
+        if 'output_file' in config:
+            tqdm.write('Режим pipeline: файлы output_file не выгружаются')
+        if incremental:
+            new_watermark = merge_watermark(max_watermark, watermark)
+    elif use_chunks(config):
+        new_watermark = export_chunks(config, query, params, watermark)
+    else:
+        with stage('read') as read:
+            new_df = script(config['db'], query, params,
+                            config.get('partition'))
+            read.rows = len(new_df)
+
+        if 'output_db' in config:
+            save_to_pg(
+                config['output_db'],
+                new_df,
+                config['output_db']['table'],
+                config['output_db']['replace'],
+                incremental.get('key'),
+            )
+
+        # Типы ужимаются после загрузки в output_db, чтобы не менять
+        # типы столбцов целевой таблицы
+        if config.get('optimize_dtypes'):
+            from utils.dtypes import memory_report, optimize_dtypes
+
+            with stage('optimize_dtypes', rows=len(new_df)):
+                optimized_df = optimize_dtypes(new_df,
+                                               config['optimize_dtypes'])
+            memory_report(new_df, optimized_df)
+            new_df = optimized_df
+
+        writer = make_writer(config)
+        writer.write(new_df)
+        writer.close()
+        if incremental:
+            new_watermark = get_max_watermark(
+                new_df, incremental['column'], watermark
+            )
+
+    if incremental and new_watermark != watermark:
+        write_watermark(incremental, state_name, new_watermark, state_db)
+
+
 if __name__ == '__main__':
+    freeze_support()
 
     parser = ArgumentParser(
         description=version_description
@@ -80,49 +372,18 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--debug', required=False, action='store_true',
                         default=False)
     parser.add_argument('-p', '--params', required=False, default='')
+    parser.add_argument('--metrics-log', required=False, default=None,
+                        help='Файл для записей об этапах (JSON Lines)')
+    parser.add_argument('--profile', required=False, default=None,
+                        help='Файл для профиля cProfile')
 
     args = parser.parse_args()
 
     basicConfig(level=args.debug and DEBUG or INFO)
+    if args.metrics_log:
+        log_to_file(args.metrics_log)
 
     config = read_config(args.config)
 
-    if args.params:
-        if ',' in args.params:
-            new_df = script(
-                config['db'],
-                config['query'].format(*args.params.split(','))
-            )
-        else:
-            new_df = script(
-                config['db'],
-                config['query'].format(args.params)
-            )
-    else:
-        new_df = script(
-            config['db'],
-            config['query']
-        )
-
-    if 'output_db' in config:
-        save_to_pg(
-            config['output_db'],
-            new_df,
-            config['output_db']['table'],
-            config['output_db']['replace'],
-        )
-
-    try:
-        tqdm.write(f"Сохраняем в файл {config['output_file']}.xml")
-        new_df.to_xml(f"{config['output_file']}.xml")
-    except ValueError:
-        tqdm.write('В XML сохранить не получилось -- '
-                   'возможно поля на русском языке')
-
-    tqdm.write(f"Сохраняем в файл {config['output_file']}.csv")
-    new_df.to_csv(f"{config['output_file']}.csv")
-    tqdm.write(f"Сохраняем в файл {config['output_file']}.xlsx")
-    new_df.to_excel(f"{config['output_file']}.xlsx")
-    tqdm.write(f"Сохраняем в файл {config['output_file']}.json")
-    new_df.to_json(f"{config['output_file']}.json")
-
+    with profiled(args.profile):
+        run(config, args.params)
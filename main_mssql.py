@@ -1,39 +1,147 @@
 import json
 from argparse import ArgumentParser
 from logging import basicConfig, DEBUG, INFO
+from multiprocessing import freeze_support
 from os import getcwd
 from os.path import join
-from urllib import parse
+from time import perf_counter
 
-import pandas as pd
-from sqlalchemy import create_engine
-from yaml import SafeLoader, load
-import pyodbc
+from utils.config import read_config, use_chunks
+from utils.metrics import log_to_file, observe, profiled, stage
 
+# pandas, SQLAlchemy и pyodbc (его загружает диалект mssql+pyodbc)
+# импортируются в функциях, которым они нужны
 
-def read_config(config_filepath):
-    with open(config_filepath, 'r', encoding="utf-8") as f:
-        return load(f, Loader=SafeLoader)
 
+def make_frame(rows, columns, offset=0):
+    import pandas as pd
 
-def script(db_config, query):
-    engine = create_engine(
-        'mssql+pyodbc://{}:{}@{}/{}?driver=ODBC+Driver+17+for+SQL+Server'.format(
-            db_config['database_login'],
-            parse.quote_plus(db_config['database_password']),
-            db_config['database_server'],
-            db_config['database']
-        ))
+    # Строки pyodbc сразу раскладываются по столбцам; Decimal, как и в
+    # read_sql, приводится к float
+    frame = pd.DataFrame.from_records(rows, columns=columns,
+                                      coerce_float=True)
+    frame.index += offset
+    return frame
 
-    result = pd.read_sql(
-        query,
-        engine
+
+def execute(connection, query, arraysize):
+    # Запрос выполняется прямо на курсоре pyodbc: строки не проходят через
+    # результат SQLAlchemy, а забираются пачками по arraysize
+    cursor = connection.connection.cursor()
+    cursor.arraysize = arraysize
+    cursor.execute(query)
+    return cursor, [column[0] for column in cursor.description]
+
+
+def script(db_config, query, partition=None, arraysize=10000):
+    from utils.engines import connect
+    from utils.partitions import can_partition, read_partitioned
+
+    if partition and can_partition(query, 'mssql'):
+        return read_partitioned(db_config, query, None, partition, 'mssql')
+
+    # Весь результат собирается в таблицу один раз, чтобы типы столбцов
+    # определялись по всем строкам, а не по отдельным пачкам
+    with connect(db_config, 'mssql') as connection:
+        cursor, columns = execute(connection, query, arraysize)
+        try:
+            rows = []
+            while True:
+                batch = cursor.fetchmany(arraysize)
+                if not batch:
+                    break
+                rows += batch
+        finally:
+            cursor.close()
+
+    return make_frame(rows, columns)
+
+
+def script_chunks(db_config, query, chunksize):
+    from utils.engines import connect
+
+    with connect(db_config, 'mssql') as connection:
+        cursor, columns = execute(connection, query, chunksize)
+        try:
+            offset = 0
+            start = perf_counter()
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows and offset:
+                    break
+                chunk = make_frame(rows, columns, offset)
+                observe('read', perf_counter() - start, len(chunk))
+                yield chunk
+                if not rows:
+                    break
+                offset += len(chunk)
+                start = perf_counter()
+        finally:
+            cursor.close()
+
+
+def key_values(series):
+    # После optimize_dtypes пропуски могут быть pd.NA, которого json не
+    # знает
+    values = series.astype(object)
+    return values.where(values.notna(), None).tolist()
+
+
+def run(config):
+    from utils.writers import ParallelWriter
+
+    # С chunksize выгрузка идёт по частям: в памяти только одна пачка, а
+    # из ключевого столбца копятся лишь его значения
+    streaming = use_chunks(config)
+    writer = ParallelWriter(
+        config.get('output_file', 'result'),
+        config.get('output_formats', ['csv', 'xlsx', 'json']),
+        streaming=streaming,
+        parallel=config.get('parallel_writers', True),
+        options={
+            'csv': config.get('csv', {}),
+            'json': {
+                'orient': 'records',
+                'date_format': 'iso',
+                **config.get('json', {}),
+            },
+            'xlsx': config.get('xlsx', {}),
+        }
     )
+    keys = []
+    try:
+        if streaming:
+            for chunk in script_chunks(config['db'], config['query'],
+                                       config['chunksize']):
+                writer.write(chunk)
+                if 'key' in config:
+                    keys += key_values(chunk[config['key']])
+        else:
+            with stage('read') as read:
+                result = script(config['db'], config['query'],
+                                config.get('partition'),
+                                config.get('arraysize', 10000))
+                read.rows = len(result)
+            if config.get('optimize_dtypes'):
+                from utils.dtypes import memory_report, optimize_dtypes
 
-    return result
+                with stage('optimize_dtypes', rows=len(result)):
+                    optimized = optimize_dtypes(result,
+                                                config['optimize_dtypes'])
+                memory_report(result, optimized)
+                result = optimized
+            writer.write(result)
+            if 'key' in config:
+                keys = key_values(result[config['key']])
+    finally:
+        writer.close()
+    if 'key' in config:
+        with open('result_key.json', 'w') as f:
+            json.dump(keys, f)
 
 
 if __name__ == '__main__':
+    freeze_support()
 
     parser = ArgumentParser(
         description='Инструмент консольной выгрузки таблиц из MSSSQL.'
@@ -42,18 +150,18 @@ if __name__ == '__main__':
                         default=join(getcwd(), 'config.yml'))
     parser.add_argument('-d', '--debug', required=False, action='store_true',
                         default=False)
+    parser.add_argument('--metrics-log', required=False, default=None,
+                        help='Файл для записей об этапах (JSON Lines)')
+    parser.add_argument('--profile', required=False, default=None,
+                        help='Файл для профиля cProfile')
 
     args = parser.parse_args()
 
     basicConfig(level=args.debug and DEBUG or INFO)
+    if args.metrics_log:
+        log_to_file(args.metrics_log)
 
     config = read_config(args.config)
 
-    result = script(config['db'], config['query'])
-
-    result.to_csv('result.csv')
-    result.to_excel('result.xlsx')
-    result.to_json('result.json', orient='records', date_format='iso')
-    if 'key' in config:
-        with open('result_key.json', 'w') as f:
-            json.dump(result.to_dict(orient='list')[config['key']], f)
+    with profiled(args.profile):
+        run(config)
@@ -1,45 +1,140 @@
 from argparse import ArgumentParser
 from logging import basicConfig, DEBUG, INFO
+from multiprocessing import freeze_support
 from os import getcwd
 from os.path import join
 
-import pandas as pd
-import urllib3
-from pandas import DataFrame
-from sqlalchemy import create_engine
-from tqdm import tqdm
-from yaml import SafeLoader, load
-import sqlalchemy.sql.default_comparator
-import psycopg2
+from utils.config import read_config
+from utils.metrics import log_to_file, observe, profiled, stage
 
-from ia_api.iaimportexport import IAImportExport
-
-
-def read_config(config_filepath):
-    with open(config_filepath, 'r', encoding="utf-8") as f:
-        return load(f, Loader=SafeLoader)
+# Тяжёлые зависимости (pandas, SQLAlchemy, requests) импортируются в
+# функциях, чтобы --help и запуск бинарника не ждали их без нужды
 
 
 def script(db_config, query):
-    engine = create_engine('postgresql://{}:{}@{}:{}/{}'.format(
-        db_config['database_login'],
-        db_config['database_password'],
-        db_config['database_server'],
-        db_config['database_port'],
-        db_config['database']
-    ))
+    import pandas as pd
+    from tqdm import tqdm
+    from utils.engines import connect
 
     tqdm.write('Отправляем запрос')
-    result = pd.read_sql(
-        query,
-        engine
-    )
+    with connect(db_config) as connection:
+        result = pd.read_sql(
+            query,
+            connection
+        )
     tqdm.write('Получили ответ')
 
     return result
 
 
+def transform_wip(result, ia):
+    import numpy as np
+    import pandas as pd
+
+    operation_name = result['#operation_name']
+    route_phase = result['#route_phase']
+    erp_finished = operation_name == 'ERP_FINISHED'
+    stock = operation_name == 'STOCK'
+    vpsk = result['operation_id'].str.contains('VPSK', regex=False, na=False)
+
+    result = result.copy()
+    result.loc[vpsk, 'operation_id'] = ''
+    result.loc[vpsk, 'operation_progress'] = 100
+    result.loc[vpsk, 'batch_id'] = \
+        result.loc[vpsk, 'batch_id'].astype(str) + '_done'
+
+    # Справочники IA запрашиваются один раз на уникальное значение,
+    # а не на каждую строку НЗП
+    last_operation = {
+        phase: ia.get_last_phase_operation(phase)
+        for phase in route_phase[erp_finished].unique()
+    }
+    first_operation = {
+        phase: ia.get_first_phase_operation(phase)
+        for phase in route_phase[stock].unique()
+    }
+    result.loc[erp_finished, 'operation_id'] = \
+        route_phase[erp_finished].map(last_operation)
+    result.loc[erp_finished, 'operation_progress'] = 100
+    result.loc[stock, 'operation_id'] = route_phase[stock].map(first_operation)
+
+    # Для изделий, у которых первая фаза не нашлась (KeyError), PROVIDED
+    # не ставится, даже если фаза строки пустая: маркер не равен ничему
+    # и не считается пропуском
+    not_found = object()
+
+    def get_entity_first_phase(code):
+        try:
+            return ia.get_entity_first_phase(ia.get_entity_id(code))
+        except KeyError:
+            return not_found
+
+    finished_or_stock = erp_finished | stock
+    codes = result.loc[finished_or_stock, 'code']
+    first_phase = codes.map({
+        code: get_entity_first_phase(code)
+        for code in codes.unique()
+    })
+    phases = route_phase[finished_or_stock]
+    provided = pd.Series(False, index=result.index)
+    provided[finished_or_stock] = (
+        (phases == first_phase)
+        | (phases.isnull() & first_phase.isnull())
+    )
+
+    positive = result['amount'] > 0
+    if not positive.any():
+        return pd.DataFrame()
+    result = result[positive].reset_index(drop=True)
+    provided = provided[positive].reset_index(drop=True)
+    result.columns = [column.upper() for column in result.columns]
+    if provided.any():
+        if 'PROVIDED' in result.columns:
+            result.loc[provided, 'PROVIDED'] = 1
+        elif provided.all():
+            result['PROVIDED'] = 1
+        else:
+            result['PROVIDED'] = provided.map({True: 1, False: np.nan})
+
+    return result.infer_objects()
+
+
+def run(config, refresh=False):
+    import urllib3
+    from ia_api.iaimportexport import IAImportExport
+    from utils.writers import ParallelWriter
+
+    with stage('read') as read:
+        result = script(config['db'], config['query'])
+        read.rows = len(result)
+
+    with IAImportExport.from_config(config['IA']) as ia:
+        urllib3.disable_warnings()
+        if refresh:
+            ia.invalidate_cache()
+        # Время получения коллекций IA входит сюда и отдельно
+        # записывается этапами ia_fetch
+        with stage('transform', rows=len(result)):
+            new_df = transform_wip(result, ia)
+        for table, (seconds, rows) in ia.fetch_stats.items():
+            observe('ia_fetch', seconds, rows, table=table)
+
+    writer = ParallelWriter(
+        config['output_file'],
+        config.get('output_formats', ['csv', 'xlsx', 'json', 'xml']),
+        parallel=config.get('parallel_writers', True),
+        options={
+            extension: config[extension]
+            for extension in ['csv', 'json', 'xlsx']
+            if extension in config
+        }
+    )
+    writer.write(new_df)
+    writer.close()
+
+
 if __name__ == '__main__':
+    freeze_support()
     parser = ArgumentParser(
         description='Инструмент консольного импорта данных в систему IA.'
     )
@@ -47,59 +142,21 @@ if __name__ == '__main__':
                         default=join(getcwd(), 'config.yml'))
     parser.add_argument('-d', '--debug', required=False, action='store_true',
                         default=False)
+    parser.add_argument('-r', '--refresh', required=False,
+                        action='store_true', default=False,
+                        help='Сбросить локальный кэш данных IA')
+    parser.add_argument('--metrics-log', required=False, default=None,
+                        help='Файл для записей об этапах (JSON Lines)')
+    parser.add_argument('--profile', required=False, default=None,
+                        help='Файл для профиля cProfile')
 
     args = parser.parse_args()
 
     basicConfig(level=args.debug and DEBUG or INFO)
+    if args.metrics_log:
+        log_to_file(args.metrics_log)
 
     config = read_config(args.config)
 
-    result = script(config['db'], config['query'])
-
-    with IAImportExport.from_config(config['IA']) as ia:
-        urllib3.disable_warnings()
-        final_result = []
-        # new_df = DataFrame()
-        for row in tqdm(result.iterrows(), desc='Разбор НЗП'):
-            if 'VPSK' in row[1]['operation_id']:
-                row[1]['operation_id'] = ''
-                row[1]['operation_progress'] = 100
-                row[1]['batch_id'] = f"{row[1]['batch_id']}_done"
-            if row[1]['#operation_name'] == 'ERP_FINISHED':
-                row[1]['operation_id'] = ia.get_last_phase_operation(row[1]['#route_phase'])
-                row[1]['operation_progress'] = 100
-                try:
-                    if row[1]['#route_phase'] == ia.get_entity_first_phase(
-                            ia.get_entity_id(row[1]['code'])
-                    ):
-                        row[1]['PROVIDED'] = 1
-                        # row[1]['PROVIDED'] = 0
-                except KeyError:
-                    pass
-            if row[1]['#operation_name'] == 'STOCK':
-                row[1]['operation_id'] = ia.get_first_phase_operation(row[1]['#route_phase'])
-                try:
-                    if row[1]['#route_phase'] == ia.get_entity_first_phase(
-                            ia.get_entity_id(row[1]['code'])
-                    ):
-                        row[1]['PROVIDED'] = 1
-                        # row[1]['PROVIDED'] = 0
-                except KeyError:
-                    pass
-
-            if row[1]['amount'] > 0:
-                final_result.append(row[1])
-        final_result = [
-            {k.upper(): v for k, v in row.items()}
-            for row in final_result
-        ]
-        new_df = DataFrame(final_result)
-
-    tqdm.write(f"Сохраняем в файл {config['output_file']}.csv")
-    new_df.to_csv(f"{config['output_file']}.csv")
-    tqdm.write(f"Сохраняем в файл {config['output_file']}.xlsx")
-    new_df.to_excel(f"{config['output_file']}.xlsx")
-    tqdm.write(f"Сохраняем в файл {config['output_file']}.json")
-    new_df.to_json(f"{config['output_file']}.json")
-    tqdm.write(f"Сохраняем в файл {config['output_file']}.xml")
-    new_df.to_xml(f"{config['output_file']}.json")
+    with profiled(args.profile):
+        run(config, args.refresh)
@@ -0,0 +1,109 @@
+import pytest
+
+from utils.config import compile_query, render_query
+
+
+@pytest.mark.parametrize('template, expected', [
+    (
+        "select * from t where d = '{0}' and n = {1}",
+        ("select * from t where d = :p0 and n = :p1", ('p0', 'p1')),
+    ),
+    (
+        "select * from t where a = {} and b = {}",
+        ("select * from t where a = :p0 and b = :p1", ('p0', 'p1')),
+    ),
+    (
+        "select * from t where d >= '{date_from}' and d < '{date_to}'",
+        (
+            "select * from t where d >= :date_from and d < :date_to",
+            ('date_from', 'date_to'),
+        ),
+    ),
+    (
+        "select '10:30' as t, 'it''s' as s from t where id = {id}",
+        (
+            "select '10:30' as t, 'it''s' as s from t where id = :id",
+            ('id',),
+        ),
+    ),
+    (
+        "select * from t where d >= '{date}'::date and id = {id}::int",
+        (
+            "select * from t where d >= :date ::date and id = :id ::int",
+            ('date', 'id'),
+        ),
+    ),
+    (
+        "select a, b from t where a in ({0}, {1}) and b between {2} and {3}",
+        (
+            "select a, b from t where a in (:p0, :p1) "
+            "and b between :p2 and :p3",
+            ('p0', 'p1', 'p2', 'p3'),
+        ),
+    ),
+    (
+        "select * from t where id in (select id from u where d = {d})",
+        (
+            "select * from t where id in (select id from u where d = :d)",
+            ('d',),
+        ),
+    ),
+])
+def test_compile_query(template, expected):
+    assert compile_query(template) == expected
+
+
+@pytest.mark.parametrize('template', [
+    # Поле внутри строки
+    "select * from t where name like '%{name}%'",
+    "select * from t where d >= '{0} 00:00:00'",
+    "select * from t where d >= '{0}T{1}'",
+    "select * from t where s = 'it''{x}'",
+    # Имя объекта
+    "select * from {table}",
+    "select * from t join {other} using (id)",
+    "select * from {schema}.t",
+    "select * from s.{table}",
+    'select "{column}" from t',
+    "select [{column}] from t",
+    "select * from t order by {column}",
+    "select {} from t",
+    "select id, {column} from t",
+    "select * from t where {column} = 1",
+    "select * from t where a = 1 and {column} in (1, 2)",
+    "select * from t where ({column} is null)",
+    # Форматирование
+    "select * from t where n = {n:>5}",
+    "select * from t where n = {n!r}",
+])
+def test_compile_query_falls_back_to_format(template):
+    assert compile_query(template) is None
+
+
+def test_render_query_falls_back_to_format():
+    query, params = render_query(
+        {'query': "select * from t where name like '%{0}%'"},
+        ['abc']
+    )
+    assert query == "select * from t where name like '%abc%'"
+    assert params is None
+
+
+def test_render_query_binds():
+    query, params = render_query(
+        {'query': "select * from t where d = '{0}' and n = {n}"},
+        ['2023-01-01'],
+        {'n': '5'}
+    )
+    assert query.text == "select * from t where d = :p0 and n = :n"
+    assert params == {'p0': '2023-01-01', 'n': '5'}
+
+
+def test_render_query_binds_cast():
+    query, params = render_query(
+        {'query': "select * from t where d >= '{0}'::date"},
+        ['2023-01-01']
+    )
+    # text() находит параметр, несмотря на приведение типа
+    assert list(query.compile().params) == ['p0']
+    assert params == {'p0': '2023-01-01'}
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+from main import copy_rows
+
+
+class Cursor(object):
+    # Вместо COPY запоминает строки CSV, которые ушли бы в базу
+
+    def __init__(self):
+        self.data = ''
+
+    def copy_expert(self, sql, buffer):
+        self.data += buffer.read()
+
+
+def test_integers_with_nulls_are_written_without_fraction():
+    df = pd.DataFrame({
+        'id': [5.0, np.nan, 7.0],
+        'amount': [1.5, 2.0, np.nan],
+        'empty': [np.nan, np.nan, np.nan],
+        'text': ['a', None, 'c'],
+    })
+    cursor = Cursor()
+    copy_rows(cursor, df, 'target', 2)
+
+    assert cursor.data == '5,1.5,\\N,a\n\\N,2.0,\\N,\\N\n7,\\N,\\N,c\n'
+    # Исходная таблица не меняется
+    assert df['id'].dtype == 'float64'
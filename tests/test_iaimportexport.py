@@ -0,0 +1,77 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from ia_api.iaimportexport import IAImportExport
+
+ROWS = [{'id': i} for i in range(500)]
+
+
+def start_server(failures):
+    # Макет rest/collection IA: окно [start, stop) и meta.count. Страница
+    # со start из failures отвечает 503 с JSON столько раз, сколько указано
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, status, data):
+            body = dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self._send(200, {'data': {}})
+
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            start = int(query['start'][0])
+            stop = int(query['stop'][0])
+            if failures.get(start):
+                failures[start] -= 1
+                self._send(503, {'meta': {'count': len(ROWS)},
+                                 'error': 'unavailable'})
+                return
+            self._send(200, {'meta': {'count': len(ROWS)},
+                             'operation': ROWS[start:stop]})
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_ia(server, tmp_path, retries):
+    return IAImportExport(
+        'login', 'password', f'http://127.0.0.1:{server.server_port}/',
+        cache_dir=str(tmp_path), page_size=100, retries=retries
+    )
+
+
+def test_failed_page_is_retried(tmp_path):
+    server = start_server({100: 1})
+    try:
+        with make_ia(server, tmp_path, retries=2) as ia:
+            assert ia._get_from_rest_collection('operation') == ROWS
+    finally:
+        server.shutdown()
+
+
+def test_failed_page_raises_instead_of_truncating(tmp_path):
+    server = start_server({100: 2})
+    try:
+        with make_ia(server, tmp_path, retries=2) as ia:
+            with pytest.raises(Exception):
+                ia._get_from_rest_collection('operation')
+            assert 'operation' not in ia.cache
+        # Ошибка сервера не попала в кэш на диске
+        with make_ia(server, tmp_path, retries=1) as ia:
+            assert ia._get_from_rest_collection('operation') == ROWS
+    finally:
+        server.shutdown()
@@ -0,0 +1,16 @@
+from utils.metrics import render_prometheus
+
+
+def test_counters_and_gauges():
+    text = render_prometheus(
+        gauges=[('response_cache_entries', {}, 2)],
+        counters=[('response_cache_hits_total', {}, 5),
+                  ('db_pool_checkouts_total', {'database': 'db'}, 7)],
+    )
+    lines = text.splitlines()
+    assert '# TYPE response_cache_entries gauge' in lines
+    assert 'response_cache_entries 2' in lines
+    assert '# TYPE response_cache_hits_total counter' in lines
+    assert 'response_cache_hits_total 5' in lines
+    assert '# TYPE db_pool_checkouts_total counter' in lines
+    assert 'db_pool_checkouts_total{database="db"} 7' in lines
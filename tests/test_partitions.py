@@ -0,0 +1,28 @@
+import pytest
+
+from utils.partitions import can_partition
+
+
+@pytest.mark.parametrize('query', [
+    'select * from t',
+    'select top 10 * from t order by id',
+    'select * from t order by id offset 0 rows',
+    'select * from (select top 5 * from t order by id) x',
+    "select * from t where s = 'order by'",
+    'select row_number() over (order by id) as n from t',
+])
+def test_mssql_query_can_be_wrapped(query):
+    assert can_partition(query, 'mssql')
+
+
+@pytest.mark.parametrize('query', [
+    'WITH a AS (select 1 as x) select * from a',
+    '-- комментарий\n;with a as (select 1 as x) select * from a',
+    'select * from t order by id',
+])
+def test_mssql_query_read_whole(query):
+    assert not can_partition(query, 'mssql')
+
+
+def test_postgres_query_always_wrapped():
+    assert can_partition('with a as (select 1) select * from a order by 1')
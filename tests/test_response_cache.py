@@ -0,0 +1,68 @@
+from asyncio import CancelledError, Event, create_task, run, sleep
+
+import pytest
+
+from utils.response_cache import ResponseCache
+
+
+def test_cached_response():
+    async def main():
+        cache = ResponseCache()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            return b'body'
+
+        assert await cache.get_or_compute('key', 60, compute) == b'body'
+        assert await cache.get_or_compute('key', 60, compute) == b'body'
+        assert len(calls) == 1
+        assert cache.hits == 1
+
+    run(main())
+
+
+def test_waiter_survives_leader_cancellation():
+    async def main():
+        cache = ResponseCache()
+        started = Event()
+
+        async def compute():
+            started.set()
+            await sleep(0.05)
+            return b'body'
+
+        leader = create_task(cache.get_or_compute('key', 60, compute))
+        await started.wait()
+        waiter = create_task(cache.get_or_compute('key', 60, compute))
+        await sleep(0)
+        leader.cancel()
+
+        assert await waiter == b'body'
+        with pytest.raises(CancelledError):
+            await leader
+        assert cache.get('key') == b'body'
+        assert cache.shared == 1
+
+    run(main())
+
+
+def test_error_is_shared():
+    async def main():
+        cache = ResponseCache()
+        started = Event()
+
+        async def compute():
+            started.set()
+            await sleep(0.01)
+            raise RuntimeError('query failed')
+
+        leader = create_task(cache.get_or_compute('key', 60, compute))
+        await started.wait()
+        waiter = create_task(cache.get_or_compute('key', 60, compute))
+        for task in [leader, waiter]:
+            with pytest.raises(RuntimeError):
+                await task
+        assert cache.get('key') is None
+
+    run(main())
@@ -0,0 +1,17 @@
+import pytest
+
+from utils.watermarks import incremental_query
+
+
+@pytest.mark.parametrize('query', [
+    'select * from t;',
+    'select * from t ;\n',
+    'select * from t;;',
+])
+def test_incremental_query_strips_semicolons(query):
+    sql, params = incremental_query(query, None, 'updated_at', 5)
+    assert sql.text == (
+        'SELECT * FROM (select * from t) AS incremental_source '
+        'WHERE "updated_at" > :watermark__'
+    )
+    assert params == {'watermark__': 5}
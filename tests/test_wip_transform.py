@@ -0,0 +1,54 @@
+from json import load
+from os.path import dirname, join
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from main_wip_imz import transform_wip
+
+DATA_DIRPATH = join(dirname(__file__), 'data')
+
+
+class StubIA(object):
+    # Фазы PH1-PH3; у изделия с id N первая фаза PHN, для E7 справочник
+    # маршрута не находится (KeyError), E9 неизвестно
+    phases = {'PH1', 'PH2', 'PH3'}
+    entities = {'E1': 1, 'E2': 2, 'E7': 7}
+
+    def get_first_phase_operation(self, phase_identity):
+        if phase_identity not in self.phases:
+            return None
+        return f'{phase_identity}_1'
+
+    def get_last_phase_operation(self, phase_identity):
+        if phase_identity not in self.phases:
+            return None
+        return f'{phase_identity}_9'
+
+    def get_entity_id(self, entity_identity):
+        return self.entities.get(entity_identity)
+
+    def get_entity_first_phase(self, entity_id):
+        if entity_id is None:
+            return None
+        if entity_id == 7:
+            raise KeyError(entity_id)
+        return f'PH{entity_id}'
+
+
+def read_frame(name):
+    with open(join(DATA_DIRPATH, name), 'r', encoding='utf-8') as f:
+        return pd.DataFrame(load(f))
+
+
+def test_transform_wip_matches_golden_file():
+    # wip_expected.json получен построчным разбором, который заменил
+    # transform_wip (legacy_transform_wip в benchmarks/bench_wip_transform)
+    actual = transform_wip(read_frame('wip_input.json'), StubIA())
+    assert_frame_equal(actual, read_frame('wip_expected.json'))
+
+
+def test_transform_wip_without_positive_amounts():
+    wip = read_frame('wip_input.json')
+    wip['amount'] = 0
+    assert transform_wip(wip, StubIA()).empty
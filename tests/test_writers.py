@@ -0,0 +1,138 @@
+from json import load
+import os
+import signal
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from utils.writers import (
+    SINKS,
+    ArrowSink,
+    CsvSink,
+    ParallelWriter,
+    ParquetSink,
+)
+
+
+def read_parquet(path):
+    return pq.read_table(path)
+
+
+def read_arrow(path):
+    with pa.ipc.open_file(path) as reader:
+        return reader.read_all()
+
+
+@pytest.mark.parametrize('sink, read', [
+    (ParquetSink, read_parquet),
+    (ArrowSink, read_arrow),
+])
+def test_column_empty_in_first_chunk(tmp_path, sink, read):
+    path = str(tmp_path / f'result.{sink.extension}')
+    writer = sink(path, streaming=True)
+    writer.write(pd.DataFrame({'id': [1, 2], 'c': [None, None]}))
+    writer.write(pd.DataFrame({'id': [3, 4], 'c': ['x', None]}))
+    writer.close()
+
+    table = read(path)
+    assert table.schema.field('c').type == pa.string()
+    assert table.column('c').to_pylist() == [None, None, 'x', None]
+    assert table.column('id').to_pylist() == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize('sink, read', [
+    (ParquetSink, read_parquet),
+    (ArrowSink, read_arrow),
+])
+def test_explicit_schema(tmp_path, sink, read):
+    path = str(tmp_path / f'result.{sink.extension}')
+    writer = sink(path, streaming=True, schema={'amount': 'float64'})
+    writer.write(pd.DataFrame({'amount': [None]}))
+    writer.write(pd.DataFrame({'amount': [1.5]}))
+    writer.close()
+
+    table = read(path)
+    assert table.schema.field('amount').type == pa.float64()
+    assert table.column('amount').to_pylist() == [None, 1.5]
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_written_files(tmp_path, parallel):
+    # Файлы прошлых выгрузок с похожими именами не считаются записанными
+    (tmp_path / 'result_2023.csv').write_text('old')
+    output_file = str(tmp_path / 'result')
+    writer = ParallelWriter(output_file, ['csv', 'xlsx'], parallel=parallel)
+    writer.write(pd.DataFrame({'id': [1, 2]}))
+    writer.close()
+
+    assert writer.files == {
+        'csv': [f'{output_file}.csv'],
+        'xlsx': [f'{output_file}.xlsx'],
+    }
+
+
+def test_no_empty_part_after_full_part(tmp_path):
+    output_file = str(tmp_path / 'result.csv')
+    writer = CsvSink(output_file, streaming=True, part_rows=2, index=False)
+    writer.write(pd.DataFrame({'id': [1, 2]}))
+    writer.write(pd.DataFrame({'id': []}))
+    writer.write(pd.DataFrame({'id': [3, 4]}))
+    writer.close()
+
+    with open(str(tmp_path / 'result.csv.manifest.json')) as f:
+        manifest = load(f)
+    assert [part['rows'] for part in manifest['parts']] == [2, 2]
+    assert writer.files == [
+        str(tmp_path / 'result_0001.csv'),
+        str(tmp_path / 'result_0002.csv'),
+    ]
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'result.csv.manifest.json', 'result_0001.csv', 'result_0002.csv',
+    ]
+
+
+def test_empty_write_after_full_part(tmp_path):
+    writer = CsvSink(str(tmp_path / 'result.csv'), streaming=True,
+                     part_rows=2, index=False)
+    writer.write(pd.DataFrame({'id': [1, 2]}))
+    writer.write(pd.DataFrame({'id': []}))
+    writer.close()
+
+    assert writer.files == [str(tmp_path / 'result_0001.csv')]
+
+
+def test_empty_result_keeps_header(tmp_path):
+    writer = CsvSink(str(tmp_path / 'result.csv'), streaming=True,
+                     part_rows=2, index=False)
+    writer.write(pd.DataFrame({'id': []}))
+    writer.close()
+
+    assert (tmp_path / 'result_0001.csv').read_text() == 'id\n'
+
+
+class KilledSink(object):
+    # Процесс записи, убитый извне, как при нехватке памяти
+    extension = 'killed'
+    cpu_bound = True
+    files = []
+
+    def __init__(self, filepath, streaming=False):
+        pass
+
+    def write(self, df):
+        os.kill(os.getpid(), signal.SIGKILL)
+
+    def close(self):
+        pass
+
+
+def test_killed_writer_process(tmp_path, monkeypatch):
+    monkeypatch.setitem(SINKS, 'killed', KilledSink)
+    writer = ParallelWriter(str(tmp_path / 'result'), ['csv', 'killed'])
+    for _ in range(5):
+        writer.write(pd.DataFrame({'id': [1, 2]}))
+    with pytest.raises(RuntimeError, match='killed'):
+        writer.close()
+    assert writer.files['csv'] == [str(tmp_path / 'result.csv')]
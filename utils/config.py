@@ -0,0 +1,161 @@
+import re
+from functools import lru_cache
+from os.path import abspath, getmtime
+from string import Formatter
+from threading import Lock
+
+from yaml import SafeLoader, load
+
+__all__ = [
+    'read_config',
+    'escape_binds',
+    'strip_semicolons',
+    'compile_query',
+    'render_query',
+    'use_chunks',
+]
+
+# То же выражение, которым SQLAlchemy находит :параметры в text()
+_BIND_RE = re.compile(r'(?<![:\w\\]):(\w+)(?!:)')
+
+# Поле на месте имени таблицы или столбца, а не значения
+_IDENTIFIER_BEFORE_RE = re.compile(
+    r'(?:\b(?:from|join|into|update|table|by)\s+|[."\[])$',
+    re.IGNORECASE
+)
+_IDENTIFIER_AFTER_RE = re.compile(r'[."\]]')
+# Поле в списке select (select {column} from t) или слева в сравнении
+# (where {column} = 1)
+_SELECT_LIST_RE = re.compile(r'\bselect\b(?:(?!\bfrom\b)[^;])*$',
+                             re.IGNORECASE | re.DOTALL)
+_CONDITION_BEFORE_RE = re.compile(
+    r'(?:\b(?:where|and|or|on|having|when)\s+|\(\s*)$',
+    re.IGNORECASE
+)
+_COMPARISON_AFTER_RE = re.compile(
+    r'\s*(?:[=<>!]|\b(?:not|in|like|ilike|is|between)\b)',
+    re.IGNORECASE
+)
+
+_configs = {}
+_lock = Lock()
+
+
+def read_config(config_filepath):
+    # Конфиг читается с диска один раз и перечитывается, только когда
+    # файл изменился
+    path = abspath(config_filepath)
+    mtime = getmtime(path)
+    with _lock:
+        cached = _configs.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    with open(path, 'r', encoding="utf-8") as f:
+        config = load(f, Loader=SafeLoader)
+    with _lock:
+        _configs[path] = (mtime, config)
+    return config
+
+
+def escape_binds(sql):
+    return _BIND_RE.sub(r'\\:\1', sql)
+
+
+def strip_semicolons(sql):
+    # Запрос с ; в конце нельзя обернуть в SELECT * FROM (...)
+    return re.sub(r'[\s;]+$', '', sql)
+
+
+@lru_cache(maxsize=256)
+def compile_query(template):
+    # Шаблон в формате str.format превращается в SQL с параметрами :name.
+    # Позиционные {} и {0} становятся :p0, :p1...; кавычки вокруг
+    # параметра ('{date}') убираются -- значение передаётся драйверу
+    # как строка. Для шаблонов, где параметр не может быть значением,
+    # возвращается None, и они подставляются через str.format:
+    # форматирование ({x:>5}, {x!r}, {x.y}), поле внутри строки
+    # ('%{name}%', '{0} 00:00:00') и имя объекта (from {table}, {s}.{t},
+    # select {column} from t, where {column} = 1). Перед приведением
+    # типа ('{date}'::date) ставится пробел: :date::date text() не
+    # считает параметром
+    fields = list(Formatter().parse(template))
+    # parts чередует текст и имена параметров: [текст, имя, текст, ...]
+    parts = ['']
+    auto_index = 0
+    quoted = False
+    strip_quote = False
+    for i, (literal, field, format_spec, conversion) in enumerate(fields):
+        opened = quoted ^ (literal[:-1].count("'") % 2 == 1)
+        quoted ^= literal.count("'") % 2 == 1
+        if strip_quote:
+            literal = literal[1:]
+            strip_quote = False
+        parts[-1] += escape_binds(literal)
+        if field is None:
+            continue
+        if format_spec or conversion or not re.fullmatch(r'\w*', field):
+            return None
+        following = fields[i + 1][0] if i + 1 < len(fields) else ''
+        if quoted:
+            # Внутри строки параметр допустим, только если это вся строка
+            if opened or literal.endswith("''") \
+                    or not following.startswith("'") \
+                    or following.startswith("''"):
+                return None
+            parts[-1] = parts[-1][:-1]
+            strip_quote = True
+        elif _IDENTIFIER_BEFORE_RE.search(parts[-1]) \
+                or _IDENTIFIER_AFTER_RE.match(following) \
+                or _SELECT_LIST_RE.search(''.join(parts[::2])) \
+                or _CONDITION_BEFORE_RE.search(parts[-1]) \
+                and _COMPARISON_AFTER_RE.match(following):
+            return None
+        if field == '':
+            field = str(auto_index)
+            auto_index += 1
+        parts.append(f'p{field}' if field.isdigit() else field)
+        parts.append('')
+
+    names = tuple(parts[1::2])
+    sql = ''.join(
+        (f':{part} ' if parts[i + 1].startswith('::') else f':{part}')
+        if i % 2 else part
+        for i, part in enumerate(parts)
+    )
+    return sql, names
+
+
+def render_query(config, args=(), kwargs=None):
+    kwargs = kwargs or {}
+    template = config['query']
+    compiled = None
+    if config.get('query_params', 'bind') == 'bind':
+        compiled = compile_query(template)
+    if compiled is None:
+        return template.format(*args, **kwargs), None
+
+    # SQLAlchemy импортируется здесь, чтобы чтение конфига его не требовало
+    from sqlalchemy import text
+
+    sql, names = compiled
+    values = {f'p{i}': value for i, value in enumerate(args)}
+    values.update(kwargs)
+    return text(sql), {name: values[name] for name in names}
+
+
+def use_chunks(config):
+    # С partition результат читается параллельными запросами целиком, и
+    # chunksize не учитывается (так в main.py и main_mssql.py). По частям
+    # optimize_dtypes не применяется: типы одной пачки не годятся для
+    # следующих
+    if 'chunksize' not in config:
+        return False
+    from tqdm import tqdm
+
+    if config.get('partition'):
+        tqdm.write('Задан partition: chunksize не учитывается, результат '
+                   'читается целиком')
+        return False
+    if config.get('optimize_dtypes'):
+        tqdm.write('В режиме chunksize optimize_dtypes не применяется')
+    return True
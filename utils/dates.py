@@ -0,0 +1,46 @@
+import re
+
+import pandas as pd
+
+__all__ = [
+    'resolve_date_columns',
+    'parse_iso_dates',
+]
+
+_ISO_RE = re.compile(r'^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}.*[+-]\d{2}:\d{2}$')
+
+
+def resolve_date_columns(df, spec):
+    if spec == 'auto':
+        columns = []
+        for column in df.columns:
+            if df[column].dtype != object:
+                continue
+            index = df[column].first_valid_index()
+            if index is None:
+                continue
+            value = df[column][index]
+            if isinstance(value, str) and _ISO_RE.match(value):
+                columns.append(column)
+        return columns
+    return [
+        column for column in spec
+        if column in df.columns and df[column].dtype == object
+    ]
+
+
+def parse_iso_dates(series):
+    # Строки вида '2023-01-01T10:00:00.123+03:00': дробная часть секунд
+    # отбрасывается, как и раньше. Дата и время разбираются быстрым
+    # разбором без часового пояса, а смещение -- один раз на всю колонку
+    offsets = series.str[-6:].dropna().unique()
+    if len(offsets) != 1:
+        return pd.to_datetime(
+            series.str[:19] + series.str[-6:],
+            format='%Y-%m-%dT%H:%M:%S%z'
+        )
+    tz = pd.Timestamp(f'2000-01-01T00:00:00{offsets[0]}').tz
+    return pd.to_datetime(
+        series.str[:19],
+        format='%Y-%m-%dT%H:%M:%S'
+    ).dt.tz_localize(tz)
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import infer_dtype
+from tqdm import tqdm
+
+__all__ = [
+    'optimize_dtypes',
+    'memory_report',
+]
+
+_MB = 2 ** 20
+
+
+def _as_options(options):
+    if options is True or options is None:
+        return {}
+    return dict(options)
+
+
+def _optimize_column(series, options):
+    kind = series.dtype.kind
+    if kind in 'iu':
+        return pd.to_numeric(series, downcast='integer' if kind == 'i'
+                             else 'unsigned')
+
+    if kind == 'f':
+        values = series.dropna()
+        # Целые столбцы с NULL приходят из read_sql как float64 --
+        # их без потерь можно хранить как nullable Int
+        if options.get('nullable_ints', True) and len(values) \
+                and np.array_equal(values, np.floor(values)) \
+                and values.abs().max() < 2 ** 53:
+            return pd.to_numeric(
+                series.astype('Int64'), downcast='integer'
+            )
+        if options.get('downcast_floats', False):
+            return pd.to_numeric(series, downcast='float')
+        return series
+
+    if kind == 'O' and infer_dtype(series, skipna=True) == 'string':
+        unique = series.nunique(dropna=True)
+        if unique <= len(series) * options.get('category_threshold', 0.5):
+            return series.astype('category')
+        if options.get('arrow_strings', False):
+            return series.astype('string[pyarrow]')
+    return series
+
+
+def optimize_dtypes(df, options=True):
+    # Строки с небольшим числом различных значений становятся category,
+    # целые ужимаются до минимальной разрядности, float64 без дробной
+    # части -- до nullable Int. float32 и строки в Arrow включаются
+    # отдельно: первое теряет точность, второе требует pyarrow
+    options = _as_options(options)
+    result = df.copy(deep=False)
+    for i in range(len(df.columns)):
+        result.isetitem(i, _optimize_column(df.iloc[:, i], options))
+    return result
+
+
+def memory_report(before, after):
+    usage_before = before.memory_usage(index=False, deep=True)
+    usage_after = after.memory_usage(index=False, deep=True)
+    for i, column in enumerate(before.columns):
+        dtype_before, dtype_after = before.dtypes.iloc[i], after.dtypes.iloc[i]
+        if dtype_before != dtype_after:
+            tqdm.write(
+                f'  {column}: {dtype_before} -> {dtype_after}, '
+                f'{usage_before.iloc[i] / _MB:.1f} -> '
+                f'{usage_after.iloc[i] / _MB:.1f} МБ'
+            )
+    tqdm.write(
+        f'Память: {usage_before.sum() / _MB:.1f} -> '
+        f'{usage_after.sum() / _MB:.1f} МБ'
+    )
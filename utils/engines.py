@@ -0,0 +1,174 @@
+import atexit
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from urllib import parse
+
+from sqlalchemy import create_engine, event
+
+__all__ = [
+    'get_engine',
+    'connect',
+    'begin',
+    'pool_stats',
+    'dispose_engines',
+]
+
+_CONNECTION_KEYS = (
+    'database',
+    'database_server',
+    'database_port',
+    'database_login',
+    'database_password',
+)
+
+_POOL_DEFAULTS = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_pre_ping': True,
+    'pool_recycle': 3600,
+}
+
+_CONNECT_DEFAULTS = {
+    'statement_timeout': None,
+}
+
+_engines = {}
+_wait_time = {}
+_checkouts = {}
+_connections = {}
+_lock = Lock()
+
+
+def _make_url(db_config, dialect):
+    if dialect == 'mssql':
+        return 'mssql+pyodbc://{}:{}@{}/{}' \
+               '?driver=ODBC+Driver+17+for+SQL+Server'.format(
+                    db_config['database_login'],
+                    parse.quote_plus(db_config['database_password']),
+                    db_config['database_server'],
+                    db_config['database']
+                )
+    return 'postgresql://{}:{}@{}:{}/{}'.format(
+        db_config['database_login'],
+        db_config['database_password'],
+        db_config['database_server'],
+        db_config['database_port'],
+        db_config['database']
+    )
+
+
+def _make_key(db_config, dialect):
+    # В ключ попадают только параметры подключения и пула: блоки db и
+    # output_db с одинаковым сервером делят один пул, а поля вроде
+    # table/replace на него не влияют
+    return (dialect,) + tuple(
+        str(db_config.get(key, '')).strip() for key in _CONNECTION_KEYS
+    ) + tuple(
+        db_config.get(key, default) for key, default in _POOL_DEFAULTS.items()
+    ) + tuple(
+        db_config.get(key, default)
+        for key, default in _CONNECT_DEFAULTS.items()
+    )
+
+
+def _make_connect_args(db_config, dialect):
+    connect_args = {}
+    # statement_timeout (мс) обрывает запрос на стороне сервера, чтобы
+    # зависший запрос не занимал соединение и поток
+    if dialect == 'postgresql' and db_config.get('statement_timeout'):
+        connect_args['options'] = '-c statement_timeout={}'.format(
+            int(db_config['statement_timeout'])
+        )
+    return connect_args
+
+
+def get_engine(db_config, dialect='postgresql'):
+    key = _make_key(db_config, dialect)
+    with _lock:
+        if key not in _engines:
+            _engines[key] = create_engine(
+                _make_url(db_config, dialect),
+                connect_args=_make_connect_args(db_config, dialect),
+                **{
+                    option: db_config.get(option, default)
+                    for option, default in _POOL_DEFAULTS.items()
+                }
+            )
+            _wait_time[key] = 0.
+            _checkouts[key] = 0
+            _connections[key] = 0
+            # Сколько физических соединений открыто за всё время -- при
+            # хорошем переиспользовании пула их намного меньше, чем checkouts
+            event.listen(
+                _engines[key].pool,
+                'connect',
+                lambda *args, key=key: _register_connection(key)
+            )
+        return _engines[key]
+
+
+def _register_connection(key):
+    with _lock:
+        if key in _connections:
+            _connections[key] += 1
+
+
+def _register_wait(db_config, dialect, elapsed):
+    key = _make_key(db_config, dialect)
+    with _lock:
+        _wait_time[key] += elapsed
+        _checkouts[key] += 1
+
+
+@contextmanager
+def connect(db_config, dialect='postgresql', **execution_options):
+    engine = get_engine(db_config, dialect)
+    start = perf_counter()
+    connection = engine.connect()
+    _register_wait(db_config, dialect, perf_counter() - start)
+    try:
+        if execution_options:
+            connection = connection.execution_options(**execution_options)
+        yield connection
+    finally:
+        connection.close()
+
+
+@contextmanager
+def begin(db_config, dialect='postgresql'):
+    with connect(db_config, dialect) as connection:
+        with connection.begin():
+            yield connection
+
+
+def pool_stats():
+    with _lock:
+        return [
+            {
+                'dialect': key[0],
+                'database': key[1],
+                'database_server': key[2],
+                'database_port': key[3],
+                'pool_size': engine.pool.size(),
+                'checked_out': engine.pool.checkedout(),
+                'overflow': engine.pool.overflow(),
+                'checkouts': _checkouts[key],
+                'connections': _connections[key],
+                'wait_time': _wait_time[key],
+            }
+            for key, engine in _engines.items()
+        ]
+
+
+def dispose_engines():
+    with _lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _wait_time.clear()
+        _checkouts.clear()
+        _connections.clear()
+
+
+atexit.register(dispose_engines)
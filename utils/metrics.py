@@ -0,0 +1,156 @@
+from contextlib import contextmanager
+from json import dumps
+from logging import FileHandler, Formatter, getLogger
+from threading import Lock
+from time import perf_counter
+
+try:
+    from resource import RUSAGE_SELF, getrusage
+except ImportError:
+    getrusage = None
+
+__all__ = [
+    'peak_rss_mb',
+    'stage',
+    'observe',
+    'stage_stats',
+    'render_prometheus',
+    'log_to_file',
+    'profiled',
+]
+
+logger = getLogger('metrics')
+
+_stages = {}
+_lock = Lock()
+
+
+def peak_rss_mb():
+    # ru_maxrss -- пик за всё время процесса (в КБ на Linux); на Windows
+    # модуля resource нет
+    if getrusage is None:
+        return None
+    return round(getrusage(RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def observe(name, seconds, rows=None, nbytes=None, **fields):
+    with _lock:
+        totals = _stages.setdefault(
+            name,
+            {'count': 0, 'seconds': 0., 'rows': 0, 'bytes': 0}
+        )
+        totals['count'] += 1
+        totals['seconds'] += seconds
+        totals['rows'] += rows or 0
+        totals['bytes'] += nbytes or 0
+    # Каждая запись -- одна строка JSON, чтобы логи можно было разбирать
+    # без регулярных выражений
+    record = {'stage': name, 'seconds': round(seconds, 3)}
+    if rows is not None:
+        record['rows'] = rows
+        record['rows_per_sec'] = round(rows / max(seconds, 1e-9))
+    if nbytes is not None:
+        record['bytes'] = nbytes
+    record['peak_rss_mb'] = peak_rss_mb()
+    record.update(fields)
+    logger.info(dumps(record, ensure_ascii=False, default=str))
+
+
+class _Stage(object):
+    __slots__ = ('rows', 'bytes', 'fields')
+
+    def __init__(self, rows, fields):
+        self.rows = rows
+        self.bytes = None
+        self.fields = fields
+
+
+@contextmanager
+def stage(name, rows=None, **fields):
+    # with stage('read') as s: df = ...; s.rows = len(df)
+    current = _Stage(rows, fields)
+    start = perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.fields['error'] = repr(e)
+        raise
+    finally:
+        observe(name, perf_counter() - start, current.rows, current.bytes,
+                **current.fields)
+
+
+def stage_stats():
+    with _lock:
+        return {name: dict(totals) for name, totals in _stages.items()}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _render_samples(lines, samples, kind):
+    seen = set()
+    for name, labels, value in samples:
+        if name not in seen:
+            lines.append(f'# TYPE {name} {kind}')
+            seen.add(name)
+        label_text = ','.join(
+            f'{key}="{_escape(label)}"' for key, label in labels.items()
+        )
+        lines.append(f'{name}{{{label_text}}} {value}' if label_text
+                     else f'{name} {value}')
+
+
+def render_prometheus(gauges=(), counters=()):
+    # Текстовый формат Prometheus: счётчики по этапам и произвольные
+    # значения (name, labels, value) от вызывающего. В counters --
+    # накопленные с запуска величины, их имена оканчиваются на _total
+    lines = []
+    stats = stage_stats()
+    for metric, key, kind in [
+        ('export_stage_runs_total', 'count', 'counter'),
+        ('export_stage_seconds_total', 'seconds', 'counter'),
+        ('export_stage_rows_total', 'rows', 'counter'),
+        ('export_stage_bytes_total', 'bytes', 'counter'),
+    ]:
+        lines.append(f'# TYPE {metric} {kind}')
+        for name, totals in stats.items():
+            lines.append(
+                f'{metric}{{stage="{_escape(name)}"}} {totals[key]}'
+            )
+
+    rss = peak_rss_mb()
+    if rss is not None:
+        gauges = list(gauges) + [('process_peak_rss_bytes', {},
+                                  int(rss * 2 ** 20))]
+    _render_samples(lines, gauges, 'gauge')
+    _render_samples(lines, counters, 'counter')
+    return '\n'.join(lines) + '\n'
+
+
+def log_to_file(path):
+    # Записи этапов дублируются в файл в виде JSON Lines
+    handler = FileHandler(path, encoding='utf-8')
+    handler.setFormatter(Formatter('%(message)s'))
+    logger.addHandler(handler)
+
+
+@contextmanager
+def profiled(path):
+    # Профиль cProfile сохраняется в path (смотреть через pstats или
+    # snakeviz), а двадцать самых затратных функций выводятся сразу
+    if not path:
+        yield
+        return
+    from cProfile import Profile
+    from pstats import Stats
+
+    profile = Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        Stats(profile).sort_stats('cumulative').print_stats(20)
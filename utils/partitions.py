@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+import re
+
+import pandas as pd
+from sqlalchemy import text
+from tqdm import tqdm
+
+from utils.config import escape_binds, strip_semicolons
+from utils.engines import connect
+
+__all__ = [
+    'split_range',
+    'can_partition',
+    'read_partitioned',
+]
+
+
+def split_range(low, high, count):
+    if low is None or high is None:
+        return []
+    if isinstance(low, int) and isinstance(high, int):
+        step = max(ceil((high - low + 1) / count), 1)
+    else:
+        step = (high - low) / count
+    bounds = [low + step * i for i in range(count)]
+    # Последний диапазон открыт сверху, чтобы не потерять максимум
+    return [
+        [bound, bounds[i + 1] if i + 1 < len(bounds) else None]
+        for i, bound in enumerate(bounds)
+        if bound <= high
+    ]
+
+
+def _top_level(sql):
+    # Текст запроса без строк, комментариев и всего, что внутри скобок
+    sql = re.sub(r"'(?:[^']|'')*'|--[^\n]*|/\*.*?\*/", ' ', sql, flags=re.S)
+    depth = 0
+    text_outside = []
+    for char in sql:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0:
+            text_outside.append(char)
+    return ''.join(text_outside).lower()
+
+
+def can_partition(query, dialect='postgresql'):
+    # Запрос читается как подзапрос SELECT * FROM (...). SQL Server не
+    # допускает в подзапросе WITH и ORDER BY без TOP/OFFSET -- такие
+    # запросы читаются целиком
+    if dialect != 'mssql':
+        return True
+    sql = _top_level(query.text if hasattr(query, 'text') else query)
+    if re.match(r'\s*;?\s*with\b', sql):
+        reason = 'запрос начинается с WITH'
+    elif re.search(r'\border\s+by\b', sql) \
+            and not re.search(r'\b(?:top|offset)\b|\bfor\s+xml\b', sql):
+        reason = 'ORDER BY без TOP'
+    else:
+        return True
+    tqdm.write(f'Разбиение на диапазоны невозможно ({reason}), запрос '
+               f'читается целиком')
+    return False
+
+
+def _read_part(db_config, dialect, statement, params):
+    with connect(db_config, dialect) as connection:
+        return pd.read_sql(statement, connection, params=params)
+
+
+def read_partitioned(db_config, query, params, partition,
+                     dialect='postgresql'):
+    sql = query.text if hasattr(query, 'text') else escape_binds(query)
+    sql = strip_semicolons(sql)
+    column = '"{}"'.format(partition['column'])
+    source = f'SELECT * FROM ({sql}) AS partition_source'
+    params = params or {}
+
+    ranges = partition.get('ranges')
+    if ranges is None:
+        with connect(db_config, dialect) as connection:
+            low, high = connection.execute(
+                text(f'SELECT min({column}), max({column}) FROM ({sql}) '
+                     f'AS partition_bounds'),
+                params
+            ).one()
+        ranges = split_range(low, high, partition.get('count', 4))
+
+    # Каждый диапазон читается своим запросом на отдельном соединении из
+    # пула; строки с NULL в столбце разбиения читаются отдельно
+    parts = [(f'{source} WHERE {column} IS NULL', params)]
+    for low, high in ranges:
+        conditions = []
+        part_params = dict(params)
+        if low is not None:
+            conditions.append(f'{column} >= :partition_low__')
+            part_params['partition_low__'] = low
+        if high is not None:
+            conditions.append(f'{column} < :partition_high__')
+            part_params['partition_high__'] = high
+        parts.append((
+            f'{source} WHERE {" AND ".join(conditions) or "1 = 1"}',
+            part_params
+        ))
+
+    tqdm.write(f'Читаем {len(parts)} диапазонов по {column} параллельно')
+    with ThreadPoolExecutor(partition.get('workers', len(parts))) as executor:
+        frames = list(executor.map(
+            lambda part: _read_part(db_config, dialect, text(part[0]),
+                                    part[1]),
+            parts
+        ))
+
+    # Пустые части не участвуют в склейке, чтобы не превращать типы
+    # столбцов в object
+    frames = [frame for frame in frames if not frame.empty] or frames[:1]
+    result = pd.concat(frames, ignore_index=True)
+    if partition.get('order_by'):
+        result = result.sort_values(
+            partition['order_by'],
+            kind='stable'
+        ).reset_index(drop=True)
+    return result
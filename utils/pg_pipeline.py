@@ -0,0 +1,224 @@
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from time import perf_counter
+
+from sqlalchemy.dialects import postgresql
+from tqdm import tqdm
+
+from utils.config import strip_semicolons
+from utils.engines import connect
+from utils.watermarks import check_upsert_key
+
+__all__ = [
+    'transfer_pg',
+]
+
+_TEXT_TYPES = {25, 1042, 1043}
+
+
+def _quote(name):
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+class _CopyPipe(object):
+    # Мост между COPY ... TO STDOUT источника и COPY ... FROM STDIN
+    # приёмника: ограниченная очередь байтовых блоков, так что память не
+    # зависит от объёма таблицы
+
+    def __init__(self, pbar, maxsize=1024):
+        self._queue = Queue(maxsize=maxsize)
+        self._aborted = Event()
+        self._buffer = b''
+        self._pbar = pbar
+        self.bytes = 0
+        self.error = None
+
+    def write(self, data):
+        while not self._aborted.is_set():
+            try:
+                self._queue.put(bytes(data), timeout=1)
+                break
+            except Full:
+                continue
+        else:
+            raise RuntimeError('Загрузка в приёмник прервана')
+        self.bytes += len(data)
+        self._pbar.update(len(data))
+
+    def close_writer(self, error=None):
+        self.error = error
+        while not self._aborted.is_set():
+            try:
+                self._queue.put(None, timeout=1)
+                return
+            except Full:
+                continue
+
+    def abort(self):
+        self._aborted.set()
+
+    def read(self, size=-1):
+        if self._buffer is None:
+            return b''
+        while len(self._buffer) < size or size < 0:
+            try:
+                data = self._queue.get(timeout=1)
+            except Empty:
+                continue
+            if data is None:
+                if self.error is not None:
+                    raise self.error
+                break
+            self._buffer += data
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            return data
+        data, self._buffer = self._buffer, None
+        return data
+
+
+def _render(cursor, query, params):
+    if params is None:
+        return query if isinstance(query, str) else query.text
+    # Параметры подставляются драйвером, т.к. COPY их не принимает
+    compiled = str(query.compile(dialect=postgresql.dialect()))
+    return cursor.mogrify(compiled, params).decode()
+
+
+def transfer_pg(source_config, target_config, query, params=None,
+                date_columns=(), key=None, watermark_column=None):
+    # Возвращает число перенесённых строк и максимум watermark_column
+    # среди них (None, если столбец не задан или строк нет)
+    name = target_config['table']
+    if isinstance(key, str):
+        key = [key]
+    keys = [_quote(column) for column in key or []]
+    with connect(source_config) as source, connect(target_config) as target:
+        source_cursor = source.connection.cursor()
+        sql = strip_semicolons(_render(source_cursor, query, params))
+
+        source_cursor.execute(
+            f'SELECT * FROM ({sql}) AS pipeline_source LIMIT 0'
+        )
+        description = source_cursor.description
+        source_cursor.execute(
+            'SELECT oid, format_type(oid, NULL) FROM pg_type '
+            'WHERE oid = ANY(%s)',
+            ([column.type_code for column in description],)
+        )
+        type_names = dict(source_cursor.fetchall())
+
+        # Даты в виде строк '2023-01-01T10:00:00.123+03:00' приводятся к
+        # timestamptz прямо в запросе, как это делает save_to_pg
+        select = []
+        columns = []
+        for column in description:
+            type_name = type_names[column.type_code]
+            if column.name in date_columns \
+                    and column.type_code in _TEXT_TYPES:
+                select.append(
+                    f'(left({_quote(column.name)}, 19) || '
+                    f'right({_quote(column.name)}, 6))::timestamptz'
+                )
+                type_name = 'timestamp with time zone'
+            else:
+                select.append(_quote(column.name))
+            columns.append(f'{_quote(column.name)} {type_name}')
+        names = [_quote(column.name) for column in description]
+
+        target_cursor = target.connection.cursor()
+        # С ключом строки вливаются через INSERT ... ON CONFLICT, и replace
+        # не применяется -- как в save_to_pg
+        if not keys and target_config.get('replace', 'replace') == 'replace':
+            target_cursor.execute(f'DROP TABLE IF EXISTS {_quote(name)}')
+        target_cursor.execute('SELECT to_regclass(%s)', (_quote(name),))
+        created = target_cursor.fetchone()[0] is None
+        target_cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {_quote(name)} '
+            f'({", ".join(columns)})'
+        )
+        if keys and created:
+            target_cursor.execute(
+                f'ALTER TABLE {_quote(name)} ADD PRIMARY KEY '
+                f'({", ".join(keys)})'
+            )
+        elif keys:
+            check_upsert_key(target, name, key)
+
+        # Для upsert и отметки строки сначала идут во временную таблицу:
+        # из неё берётся максимум отметки и она вливается в целевую
+        destination = name
+        if keys or watermark_column:
+            destination = f'{name}_delta'
+            target_cursor.execute(
+                f'CREATE TEMP TABLE {_quote(destination)} '
+                f'({", ".join(columns)}) ON COMMIT DROP'
+            )
+
+        pbar = tqdm(desc=f'{name}', unit='B', unit_scale=True)
+        pipe = _CopyPipe(pbar)
+
+        # Текстовый COPY, а не binary: в существующей таблице типы
+        # столбцов могут отличаться от источника (int4 и int8 и т.п.)
+        def copy_out():
+            try:
+                source_cursor.copy_expert(
+                    f'COPY (SELECT {", ".join(select)} '
+                    f'FROM ({sql}) AS pipeline_source) TO STDOUT',
+                    pipe
+                )
+            except Exception as e:
+                pipe.close_writer(e)
+            else:
+                pipe.close_writer()
+
+        start = perf_counter()
+        reader = Thread(target=copy_out)
+        reader.start()
+        try:
+            target_cursor.copy_expert(
+                f'COPY {_quote(destination)} ({", ".join(names)}) '
+                f'FROM STDIN',
+                pipe
+            )
+            rows = target_cursor.rowcount
+            watermark = None
+            if watermark_column:
+                target_cursor.execute(
+                    f'SELECT max({_quote(watermark_column)}) '
+                    f'FROM {_quote(destination)}'
+                )
+                watermark = target_cursor.fetchone()[0]
+            if destination != name:
+                updates = [
+                    f'{column} = excluded.{column}'
+                    for column in names if column not in keys
+                ]
+                conflict = ''
+                if keys:
+                    conflict = f' ON CONFLICT ({", ".join(keys)}) DO ' + (
+                        f'UPDATE SET {", ".join(updates)}'
+                        if updates else 'NOTHING'
+                    )
+                target_cursor.execute(
+                    f'INSERT INTO {_quote(name)} ({", ".join(names)}) '
+                    f'SELECT {", ".join(names)} '
+                    f'FROM {_quote(destination)}{conflict}'
+                )
+        except BaseException:
+            pipe.abort()
+            reader.join()
+            target.connection.rollback()
+            raise
+        finally:
+            pbar.close()
+        reader.join()
+        target.connection.commit()
+        elapsed = perf_counter() - start
+
+    tqdm.write(
+        f'Перенесено {rows} строк ({pipe.bytes / 2 ** 20:.1f} МБ) '
+        f'за {elapsed:.1f} с: {rows / max(elapsed, 1e-9):.0f} строк/с, '
+        f'{pipe.bytes / 2 ** 20 / max(elapsed, 1e-9):.1f} МБ/с'
+    )
+    return rows, watermark
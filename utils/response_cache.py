@@ -0,0 +1,100 @@
+from asyncio import get_running_loop, shield
+from collections import OrderedDict
+from time import monotonic
+
+__all__ = [
+    'ResponseCache',
+    'make_key',
+]
+
+
+def make_key(config_name, parameters, *args):
+    return (config_name, tuple(sorted(parameters.items()))) + args
+
+
+def _retrieve_exception(task):
+    # Ошибка передаётся ожидающим, но если все они ушли, не должна
+    # логироваться как необработанная
+    if not task.cancelled():
+        task.exception()
+
+
+class ResponseCache(object):
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, body = entry
+        if expires < monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return body
+
+    def put(self, key, body, ttl):
+        if len(body) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (monotonic() + ttl, body)
+        self._bytes += len(body)
+        # Вытесняем давно не использованные ответы, пока не уложимся в лимит
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        expires, body = self._entries.pop(key)
+        self._bytes -= len(body)
+
+    async def _compute(self, key, ttl, compute):
+        try:
+            body = await compute()
+        finally:
+            del self._in_flight[key]
+        self.put(key, body, ttl)
+        return body
+
+    async def get_or_compute(self, key, ttl, compute):
+        body = self.get(key)
+        if body is not None:
+            self.hits += 1
+            return body
+
+        # Одинаковые запросы, пришедшие во время выполнения первого,
+        # ждут его результата, а не идут в базу сами. Вычисление идёт
+        # отдельной задачей: если первый клиент отключится, остальные всё
+        # равно получат ответ
+        task = self._in_flight.get(key)
+        if task is None:
+            self.misses += 1
+            task = get_running_loop().create_task(
+                self._compute(key, ttl, compute)
+            )
+            task.add_done_callback(_retrieve_exception)
+            self._in_flight[key] = task
+        else:
+            self.shared += 1
+        return await shield(task)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'shared': self.shared,
+            'evictions': self.evictions,
+        }
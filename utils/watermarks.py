@@ -0,0 +1,135 @@
+from json import dump, dumps, load, loads
+from os.path import exists
+from threading import Lock
+
+from sqlalchemy import inspect, text
+
+from utils.config import escape_binds, strip_semicolons
+from utils.engines import begin
+
+__all__ = [
+    'incremental_query',
+    'check_upsert_key',
+    'get_max_watermark',
+    'merge_watermark',
+    'read_watermark',
+    'write_watermark',
+]
+
+_STATE_TABLE = 'export_watermarks'
+
+# Файл состояния общий для заданий batch.py, выполняемых в потоках
+_file_lock = Lock()
+
+
+def incremental_query(query, params, column, watermark, inclusive=False):
+    # Со строгим > строки, закоммиченные позже с той же отметкой, что и
+    # сохранённый максимум, не выгрузятся никогда. Если строки вливаются
+    # по ключу, граница берётся с >=: её строки перечитываются, а upsert
+    # делает повтор безвредным
+    if watermark is None:
+        return query, params
+    sql = query.text if hasattr(query, 'text') else escape_binds(query)
+    sql = strip_semicolons(sql)
+    operator = '>=' if inclusive else '>'
+    return text(
+        f'SELECT * FROM ({sql}) AS incremental_source '
+        f'WHERE "{column}" {operator} :watermark__'
+    ), {**(params or {}), 'watermark__': watermark}
+
+
+def check_upsert_key(connection, name, key):
+    # ON CONFLICT (key) требует первичного ключа или уникального индекса
+    # ровно по столбцам key. Выгрузка добавляет ключ, только когда сама
+    # создаёт таблицу, а в существующей его может не быть
+    inspector = inspect(connection)
+    key_columns = [inspector.get_pk_constraint(name)['constrained_columns']]
+    key_columns += [
+        constraint['column_names']
+        for constraint in inspector.get_unique_constraints(name)
+    ]
+    key_columns += [
+        index['column_names']
+        for index in inspector.get_indexes(name) if index['unique']
+    ]
+    if set(key) not in [set(columns) for columns in key_columns]:
+        raise ValueError(
+            f'В таблице {name} нет первичного ключа или уникального индекса '
+            f'по столбцам {", ".join(key)} из incremental.key: без него '
+            f'строки нельзя влить через INSERT ... ON CONFLICT'
+        )
+
+
+def get_max_watermark(df, column, watermark):
+    if df.empty or df[column].isnull().all():
+        return watermark
+    return merge_watermark(df[column].max(), watermark)
+
+
+def merge_watermark(value, watermark):
+    if value is None:
+        return watermark
+    # В состоянии хранится то, что можно положить в JSON и затем передать
+    # обратно в запрос параметром
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    elif hasattr(value, 'item'):
+        value = value.item()
+    if watermark is None or _greater(value, watermark):
+        return value
+    return watermark
+
+
+def _greater(value, watermark):
+    try:
+        return value > watermark
+    except TypeError:
+        return str(value) > str(watermark)
+
+
+def read_watermark(incremental, name, db_config=None):
+    if incremental.get('state', 'file') == 'db':
+        with begin(db_config) as connection:
+            connection.execute(text(
+                f'CREATE TABLE IF NOT EXISTS {_STATE_TABLE} ('
+                f'name TEXT PRIMARY KEY, '
+                f'value TEXT, '
+                f'updated_at TIMESTAMPTZ DEFAULT now())'
+            ))
+            value = connection.execute(
+                text(f'SELECT value FROM {_STATE_TABLE} WHERE name = :name'),
+                {'name': name}
+            ).scalar()
+        return None if value is None else loads(value)
+
+    state_file = incremental.get('state_file', 'watermarks.json')
+    with _file_lock:
+        if not exists(state_file):
+            return None
+        with open(state_file, 'r', encoding='utf-8') as f:
+            return load(f).get(name)
+
+
+def write_watermark(incremental, name, value, db_config=None):
+    if incremental.get('state', 'file') == 'db':
+        with begin(db_config) as connection:
+            connection.execute(
+                text(
+                    f'INSERT INTO {_STATE_TABLE} (name, value) '
+                    f'VALUES (:name, :value) '
+                    f'ON CONFLICT (name) DO UPDATE '
+                    f'SET value = excluded.value, updated_at = now()'
+                ),
+                {'name': name, 'value': dumps(value)}
+            )
+        return
+
+    state_file = incremental.get('state_file', 'watermarks.json')
+    with _file_lock:
+        state = {}
+        if exists(state_file):
+            with open(state_file, 'r', encoding='utf-8') as f:
+                state = load(f)
+        state[name] = value
+        with open(state_file, 'w', encoding='utf-8') as f:
+            dump(state, f, ensure_ascii=False, indent=2)
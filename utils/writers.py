@@ -0,0 +1,629 @@
+from gzip import GzipFile
+from hashlib import sha256
+from io import BufferedWriter, RawIOBase, TextIOWrapper
+from json import dump
+from multiprocessing import Process, Queue as ProcessQueue
+from os.path import basename, exists, getsize
+from queue import Empty, Full, Queue
+from threading import Thread
+from time import perf_counter
+
+from tqdm import tqdm
+
+from utils.metrics import observe
+
+__all__ = [
+    'CsvSink',
+    'JsonSink',
+    'XmlSink',
+    'XlsxSink',
+    'ParquetSink',
+    'ArrowSink',
+    'FeatherSink',
+    'SINKS',
+    'DEFAULT_FORMATS',
+    'ParallelWriter',
+]
+
+
+class _HashingFile(RawIOBase):
+    # Файл, который по ходу записи считает байты и SHA-256 того, что
+    # попадает на диск (уже после сжатия)
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self.hash = sha256()
+        self.bytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._file.write(data)
+        self.hash.update(data)
+        self.bytes += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+class _Part(object):
+
+    def __init__(self, path, compression=None, compression_level=None):
+        self.path = path
+        self.rows = 0
+        self._raw = _HashingFile(path)
+        self._compressed = None
+        if compression == 'gzip':
+            self._compressed = GzipFile(
+                fileobj=self._raw,
+                mode='wb',
+                compresslevel=compression_level or 6,
+                mtime=0
+            )
+            binary = self._compressed
+        elif compression == 'zstd':
+            import zstandard
+
+            self._compressed = zstandard.ZstdCompressor(
+                level=compression_level or 3
+            ).stream_writer(self._raw, closefd=False)
+            binary = self._compressed
+        elif compression is None:
+            binary = BufferedWriter(self._raw)
+        else:
+            raise ValueError(f'Неизвестное сжатие: {compression}')
+        self.file = TextIOWrapper(binary, encoding='utf-8', newline='')
+
+    @property
+    def bytes(self):
+        return self._raw.bytes
+
+    def close(self):
+        self.file.close()
+        if self._compressed is not None:
+            self._compressed.close()
+        self._raw.close()
+        return {
+            'path': basename(self.path),
+            'rows': self.rows,
+            'bytes': self._raw.bytes,
+            'sha256': self._raw.hash.hexdigest(),
+        }
+
+
+class _PartWriter(object):
+    # Текстовый вывод со сжатием (gzip, zstd) и делением на части
+    # result_0001.csv.gz, result_0002.csv.gz... по числу строк и/или
+    # размеру на диске. Рядом пишется манифест с числом строк, размером и
+    # SHA-256 каждой части, чтобы части можно было загружать параллельно
+    suffixes = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+    slice_rows = 10000
+
+    def __init__(self, filepath, extension, compression=None,
+                 compression_level=None, part_rows=None, part_bytes=None,
+                 manifest=None):
+        self._stem = filepath[:-len(extension) - 1]
+        self._extension = extension
+        self._compression = compression
+        self._compression_level = compression_level
+        self._part_rows = part_rows
+        self._part_bytes = part_bytes
+        self._split = bool(part_rows or part_bytes)
+        self._manifest = self._split if manifest is None else manifest
+        self._part = None
+        self._parts = []
+        self.files = []
+
+    def _path(self):
+        suffix = self.suffixes[self._compression]
+        if not self._split:
+            return f'{self._stem}.{self._extension}{suffix}'
+        return f'{self._stem}_{len(self._parts) + 1:04d}' \
+               f'.{self._extension}{suffix}'
+
+    def _close_part(self):
+        self._parts.append(self._part.close())
+        self.files.append(self._part.path)
+        self._part = None
+
+    def _full(self):
+        return self._part_rows and self._part.rows >= self._part_rows \
+            or self._part_bytes and self._part.bytes >= self._part_bytes
+
+    def write(self, df, write_rows, whole=False):
+        # write_rows(frame, file, first) пишет строки в текущую часть,
+        # first -- первая запись в эту часть (для заголовка CSV). При
+        # whole каждая запись -- отдельный документ и целиком занимает
+        # часть, поэтому делится только по part_rows. Заполненная часть
+        # сменяется следующей, только когда в ту есть что писать: иначе
+        # в конце остаётся часть из одного заголовка
+        if len(df) == 0 and (self._part is not None or self._parts):
+            return
+        start = 0
+        while True:
+            if self._part is not None and (whole and self._split
+                                           or self._full()):
+                self._close_part()
+            if self._part is None:
+                self._part = _Part(self._path(), self._compression,
+                                   self._compression_level)
+            first = self._part.rows == 0
+            size = len(df) - start
+            if self._part_rows:
+                size = min(size, self._part_rows - self._part.rows)
+            if self._part_bytes and not whole:
+                size = min(size, self.slice_rows)
+            frame = df.iloc[start:start + size]
+            write_rows(frame, self._part.file, first)
+            self._part.rows += len(frame)
+            start += size
+            if self._part_bytes:
+                self._part.file.flush()
+            if start >= len(df):
+                break
+
+    def close(self):
+        if self._part is not None:
+            self._close_part()
+        if not self._manifest:
+            return
+        with open(f'{self._stem}.{self._extension}.manifest.json', 'w',
+                  encoding='utf-8') as f:
+            dump({
+                'format': self._extension,
+                'compression': self._compression,
+                'rows': sum(part['rows'] for part in self._parts),
+                'parts': self._parts,
+            }, f, ensure_ascii=False, indent=2)
+
+
+class CsvSink(object):
+    extension = 'csv'
+    cpu_bound = False
+
+    def __init__(self, filepath, streaming=False, compression=None,
+                 compression_level=None, part_rows=None, part_bytes=None,
+                 manifest=None, **kwargs):
+        self._filepath = filepath
+        self._streaming = streaming
+        self._kwargs = kwargs
+        self._parts = _PartWriter(filepath, self.extension, compression,
+                                  compression_level, part_rows, part_bytes,
+                                  manifest)
+
+    def _write_rows(self, df, file, first):
+        # Каждая часть начинается с заголовка и читается отдельно
+        if first:
+            df.to_csv(file, **self._kwargs)
+        else:
+            df.to_csv(file, header=False, **self._kwargs)
+
+    @property
+    def files(self):
+        return self._parts.files
+
+    def write(self, df):
+        self._parts.write(df, self._write_rows)
+
+    def close(self):
+        self._parts.close()
+
+
+class JsonSink(object):
+    extension = 'json'
+    cpu_bound = False
+
+    def __init__(self, filepath, streaming=False, compression=None,
+                 compression_level=None, part_rows=None, part_bytes=None,
+                 manifest=None, **kwargs):
+        self._filepath = filepath
+        self._streaming = streaming
+        self._kwargs = kwargs
+        self._parts = _PartWriter(filepath, self.extension, compression,
+                                  compression_level, part_rows, part_bytes,
+                                  manifest)
+
+    def _write_document(self, df, file, first):
+        df.to_json(file, **self._kwargs)
+
+    def _write_lines(self, df, file, first):
+        if len(df):
+            file.write(df.to_json(
+                orient='records',
+                lines=True,
+                date_format=self._kwargs.get('date_format', 'epoch')
+            ))
+
+    @property
+    def files(self):
+        return self._parts.files
+
+    def write(self, df):
+        if not self._streaming:
+            self._parts.write(df, self._write_document, whole=True)
+            return
+        # По частям JSON пишется построчно (NDJSON): одна запись на строку
+        self._parts.write(df, self._write_lines)
+
+    def close(self):
+        self._parts.close()
+
+
+class XmlSink(object):
+    extension = 'xml'
+    cpu_bound = True
+    root_name = 'data'
+
+    def __init__(self, filepath, streaming=False, **kwargs):
+        self._filepath = filepath
+        self._streaming = streaming
+        self._kwargs = kwargs
+        self._file = None
+        self._failed = False
+        self.files = []
+
+    def write(self, df):
+        if self._failed:
+            return
+        try:
+            if not self._streaming:
+                df.to_xml(self._filepath, **self._kwargs)
+                self.files = [self._filepath]
+                return
+            body = df.to_xml(
+                root_name=self.root_name,
+                xml_declaration=False,
+                **self._kwargs
+            ).strip()
+        except ValueError:
+            self._failed = True
+            tqdm.write('В XML сохранить не получилось -- '
+                       'возможно поля на русском языке')
+            return
+        if self._file is None:
+            self._file = open(self._filepath, 'w', encoding='utf-8')
+            self.files = [self._filepath]
+            self._file.write(
+                f"<?xml version='1.0' encoding='utf-8'?>\n"
+                f"<{self.root_name}>\n"
+            )
+        # Из каждой части убираем корневой тег, оставляя только строки
+        body = body[len(f'<{self.root_name}>'):-len(f'</{self.root_name}>')]
+        self._file.write(body.strip('\n') + '\n')
+
+    def close(self):
+        if self._file is not None:
+            self._file.write(f'</{self.root_name}>\n')
+            self._file.close()
+
+
+class XlsxSink(object):
+    extension = 'xlsx'
+    cpu_bound = True
+    max_rows = 1048576
+
+    # Книга пишется в режиме write_only: строки сразу уходят во временный
+    # файл openpyxl, а не копятся в памяти. При достижении предела Excel
+    # строки продолжаются на новом листе (split: sheet) или в новом файле
+    # (split: file)
+    def __init__(self, filepath, streaming=False, index=True,
+                 sheet_name='Sheet1', max_rows=None, split='sheet'):
+        self._filepath = filepath
+        self._streaming = streaming
+        self._index = index
+        self._sheet_name = sheet_name
+        self._max_rows = min(max_rows or self.max_rows, self.max_rows)
+        self._split = split
+        self._workbook = None
+        self._sheet = None
+        self._header = None
+        self._rows = 0
+        self._sheets = 0
+        self._files = 0
+        self.files = []
+
+    def _path(self):
+        if self._files == 1:
+            return self._filepath
+        stem = self._filepath[:-len(self.extension) - 1]
+        return f'{stem}_{self._files}.{self.extension}'
+
+    def _next_sheet(self):
+        from openpyxl import Workbook
+
+        if self._workbook is None or self._split == 'file':
+            self._save()
+            self._workbook = Workbook(write_only=True)
+            self._files += 1
+            self._sheets = 0
+        self._sheets += 1
+        title = self._sheet_name if self._sheets == 1 \
+            else f'{self._sheet_name}_{self._sheets}'
+        self._sheet = self._workbook.create_sheet(title)
+        self._sheet.append(self._header)
+        self._rows = 1
+
+    def _save(self):
+        if self._workbook is not None:
+            self._workbook.save(self._path())
+            self.files.append(self._path())
+            self._workbook = None
+
+    def write(self, df):
+        if self._header is None:
+            index_names = [name or '' for name in df.index.names]
+            self._header = (index_names if self._index else []) \
+                + [str(column) for column in df.columns]
+            self._next_sheet()
+
+        # Excel не хранит часовые пояса, а пропуски должны быть пустыми
+        # ячейками, а не NaN
+        df = df.copy(deep=False)
+        for i, dtype in enumerate(df.dtypes):
+            if getattr(dtype, 'tz', None) is not None:
+                df.isetitem(i, df.iloc[:, i].dt.tz_localize(None))
+        values = df.astype(object).where(df.notna(), None)
+
+        for row in values.itertuples(index=self._index, name=None):
+            if self._rows >= self._max_rows:
+                self._next_sheet()
+            self._sheet.append(row)
+            self._rows += 1
+
+    def close(self):
+        self._save()
+
+
+def _arrow_table(df, schema, index, types=None):
+    # Схема файла задаётся первым куском. Столбец, пустой в первом куске,
+    # получил бы тип null, и куски с данными в нём потом не записались бы:
+    # такой столбец заводится строковым (или с типом из types, например
+    # {'amount': 'float64'}), а каждый следующий кусок приводится к схеме
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=index)
+    if schema is None:
+        types = types or {}
+        schema = pa.schema(
+            [
+                field.with_type(pa.type_for_alias(types[field.name]))
+                if field.name in types
+                else field.with_type(pa.string())
+                if pa.types.is_null(field.type)
+                else field
+                for field in table.schema
+            ],
+            metadata=table.schema.metadata
+        )
+    return table.cast(schema), schema
+
+
+class ParquetSink(object):
+    extension = 'parquet'
+    cpu_bound = False
+
+    def __init__(self, filepath, streaming=False, compression='zstd',
+                 row_group_size=None, index=False, schema=None):
+        self._filepath = filepath
+        self._streaming = streaming
+        self._compression = compression
+        self._row_group_size = row_group_size
+        self._index = index
+        self._types = schema
+        self._writer = None
+        self._schema = None
+        self.files = []
+
+    def write(self, df):
+        import pyarrow.parquet as pq
+
+        table, self._schema = _arrow_table(
+            df, self._schema, self._index, self._types
+        )
+        if self._writer is None:
+            self.files = [self._filepath]
+            self._writer = pq.ParquetWriter(
+                self._filepath,
+                self._schema,
+                compression=self._compression
+            )
+        self._writer.write_table(table, row_group_size=self._row_group_size)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class ArrowSink(object):
+    extension = 'arrow'
+    cpu_bound = False
+
+    def __init__(self, filepath, streaming=False, compression='zstd',
+                 index=False, schema=None):
+        self._filepath = filepath
+        self._streaming = streaming
+        self._compression = compression
+        self._index = index
+        self._types = schema
+        self._writer = None
+        self._schema = None
+        self.files = []
+
+    def write(self, df):
+        import pyarrow as pa
+
+        table, self._schema = _arrow_table(
+            df, self._schema, self._index, self._types
+        )
+        if self._writer is None:
+            self.files = [self._filepath]
+            self._writer = pa.ipc.new_file(
+                self._filepath,
+                self._schema,
+                options=pa.ipc.IpcWriteOptions(
+                    compression=self._compression
+                )
+            )
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+# Feather версии 2 -- это тот же файловый формат Arrow IPC
+class FeatherSink(ArrowSink):
+    extension = 'feather'
+
+
+SINKS = {
+    sink.extension: sink
+    for sink in [XmlSink, CsvSink, XlsxSink, JsonSink,
+                 ParquetSink, ArrowSink, FeatherSink]
+}
+
+DEFAULT_FORMATS = ['xml', 'csv', 'xlsx', 'json']
+
+
+def _run_sink(sink, queue, results):
+    elapsed = 0.
+    try:
+        while True:
+            df = queue.get()
+            if df is None:
+                break
+            start = perf_counter()
+            sink.write(df)
+            elapsed += perf_counter() - start
+        start = perf_counter()
+        sink.close()
+        elapsed += perf_counter() - start
+    except Exception as e:
+        results.put((sink.extension, elapsed, repr(e), sink.files))
+        # Дочитываем очередь, чтобы не блокировать отправителя
+        while queue.get() is not None:
+            pass
+        return
+    results.put((sink.extension, elapsed, None, sink.files))
+
+
+# Каждая порция строк раздаётся всем форматам сразу: тяжёлые для
+# процессора (XLSX, XML) пишутся в отдельных процессах, остальные -- в
+# потоках, так что общее время близко ко времени самого медленного формата
+class ParallelWriter(object):
+
+    def __init__(self, output_file, formats=None, streaming=False,
+                 parallel=True, options=None):
+        options = options or {}
+        self._output_file = output_file
+        self._parallel = parallel
+        self.rows = 0
+        self._sinks = []
+        for extension in formats or DEFAULT_FORMATS:
+            tqdm.write(f"Сохраняем в файл {output_file}.{extension}")
+            self._sinks.append(SINKS[extension](
+                f'{output_file}.{extension}',
+                streaming=streaming,
+                **options.get(extension, {})
+            ))
+        self.timings = {sink.extension: 0. for sink in self._sinks}
+        self.files = {sink.extension: [] for sink in self._sinks}
+        self._workers = {}
+        self._results = ProcessQueue()
+        if parallel:
+            for sink in self._sinks:
+                if sink.cpu_bound:
+                    queue = ProcessQueue(maxsize=2)
+                    worker = Process(target=_run_sink,
+                                     args=(sink, queue, self._results))
+                else:
+                    queue = Queue(maxsize=2)
+                    worker = Thread(target=_run_sink,
+                                    args=(sink, queue, self._results))
+                worker.start()
+                self._workers[sink.extension] = (worker, queue)
+
+    def _put(self, extension, item):
+        # Процесс записи могут убить извне (например, при нехватке
+        # памяти): тогда порции ему больше не отправляются, а ошибку
+        # сообщит close
+        worker, queue = self._workers[extension]
+        while worker.is_alive():
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Full:
+                continue
+
+    def write(self, df):
+        self.rows += len(df)
+        if self._parallel:
+            for extension in self._workers:
+                self._put(extension, df)
+            return
+        for sink in self._sinks:
+            start = perf_counter()
+            sink.write(df)
+            self.timings[sink.extension] += perf_counter() - start
+
+    def close(self):
+        errors = []
+        if self._parallel:
+            for extension in self._workers:
+                self._put(extension, None)
+            pending = set(self._workers)
+            exited = set()
+            while pending:
+                try:
+                    extension, elapsed, error, files = \
+                        self._results.get(timeout=1)
+                except Empty:
+                    # Завершившийся процесс мог успеть отправить результат,
+                    # поэтому без результата он считается упавшим только
+                    # при повторной проверке
+                    dead = {
+                        extension for extension in pending
+                        if not self._workers[extension][0].is_alive()
+                    }
+                    for extension in dead & exited:
+                        worker, queue = self._workers[extension]
+                        pending.discard(extension)
+                        # Непрочитанные порции не должны задерживать выход
+                        if hasattr(queue, 'cancel_join_thread'):
+                            queue.cancel_join_thread()
+                        errors.append(
+                            f'{extension}: процесс записи завершился с '
+                            f'кодом {getattr(worker, "exitcode", None)}'
+                        )
+                    exited = dead
+                    continue
+                pending.discard(extension)
+                self.timings[extension] = elapsed
+                self.files[extension] = files
+                if error is not None:
+                    errors.append(f'{extension}: {error}')
+            for worker, queue in self._workers.values():
+                worker.join()
+        else:
+            for sink in self._sinks:
+                start = perf_counter()
+                sink.close()
+                self.timings[sink.extension] += perf_counter() - start
+                self.files[sink.extension] = sink.files
+        for extension, elapsed in self.timings.items():
+            tqdm.write(f'Запись {extension}: {elapsed:.2f} с')
+            # Считаются только файлы, которые записал этот вывод, а не
+            # всё, что лежит рядом с похожими именами
+            observe(f'write_{extension}', elapsed, self.rows, sum(
+                getsize(path) for path in self.files[extension]
+                if exists(path)
+            ))
+        if errors:
+            raise RuntimeError(
+                'Не удалось сохранить файлы: {}'.format('; '.join(errors))
+            )
+        return self.timings
@@ -1,14 +1,28 @@
+from asyncio import Semaphore, TimeoutError, get_running_loop, shield, wait_for
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from logging import getLogger
 from typing import Union
 
 import pandas as pd
 import uvicorn
 from fastapi import FastAPI, Request
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from orjson import dumps
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 
-from main import read_config, script
+from main import script_chunks
+from utils.config import read_config, render_query
+from utils.engines import dispose_engines, pool_stats
+from utils.metrics import render_prometheus, stage
+from utils.response_cache import ResponseCache, make_key
 
 
 class Item(BaseModel):
@@ -18,24 +32,234 @@ class Item(BaseModel):
 
 
 app = FastAPI()
+logger = getLogger('web-server')
+
+# Ограничение одновременных запросов для каждого конфига
+semaphores = {}
+response_cache = ResponseCache()
+
+
+@app.on_event("startup")
+def startup():
+    app.state.executor = ThreadPoolExecutor(
+        getattr(app.state, 'db_workers', 8),
+        thread_name_prefix='db'
+    )
+
+
+@app.on_event("shutdown")
+def shutdown():
+    app.state.executor.shutdown(wait=False)
+    dispose_engines()
+
+
+async def run_in_executor(func, *args):
+    return await get_running_loop().run_in_executor(
+        app.state.executor, func, *args
+    )
+
+
+@app.get("/pool")
+async def api_pool():
+    return JSONResponse(pool_stats())
+
+
+@app.get("/cache")
+async def api_cache():
+    return JSONResponse(response_cache.stats())
+
+
+@app.get("/metrics")
+async def api_metrics():
+    gauges = []
+    counters = []
+    for pool in pool_stats():
+        labels = {
+            'dialect': pool['dialect'],
+            'database': pool['database'],
+            'server': pool['database_server'],
+        }
+        for key in ['pool_size', 'checked_out', 'overflow']:
+            gauges.append((f'db_pool_{key}', labels, pool[key]))
+        # Накопленные с запуска значения -- счётчики, чтобы по ним
+        # считались rate() и increase()
+        for key, name in [('checkouts', 'checkouts'),
+                          ('connections', 'connections'),
+                          ('wait_time', 'wait_seconds')]:
+            counters.append((f'db_pool_{name}_total', labels, pool[key]))
+    for key, value in response_cache.stats().items():
+        if key in ('hits', 'misses', 'shared', 'evictions'):
+            counters.append((f'response_cache_{key}_total', {}, value))
+        else:
+            gauges.append((f'response_cache_{key}', {}, value))
+    return PlainTextResponse(
+        render_prometheus(gauges, counters),
+        media_type='text/plain; version=0.0.4'
+    )
+
+
+def encode_records(chunk):
+    # Пустые значения в ответ не попадают, остальное кодируется как в
+    # jsonable_encoder
+    with stage('encode', rows=len(chunk)) as encode:
+        records = [
+            dumps(
+                {k: v for k, v in m.items() if pd.notnull(v)},
+                default=jsonable_encoder
+            )
+            for m in chunk.to_dict(orient='records')
+        ]
+        encode.bytes = sum(len(record) for record in records)
+    return records
+
+
+class Batches(object):
+    # Курсор запроса и место в семафоре конфига. Освобождаются один раз:
+    # из генератора ответа или фоновой задачей ответа, если тело так и не
+    # начали читать (клиент ушёл раньше, ошибка до отправки). Пока выборка
+    # идёт в пуле потоков, место не возвращается: иначе по таймауту
+    # запросов к базе окажется больше max_concurrency
+
+    def __init__(self, batches, semaphore):
+        self.batches = batches
+        self._semaphore = semaphore
+        self._released = False
+        self._fetching = None
+
+    async def fetch(self, timeout):
+        # Запрос выполняется в отдельном пуле потоков и не блокирует цикл
+        # событий; по таймауту ответ прерывается, а выборка продолжается
+        # до конца
+        self._fetching = get_running_loop().run_in_executor(
+            app.state.executor, next, self.batches, None
+        )
+        chunk = await wait_for(shield(self._fetching), timeout)
+        self._fetching = None
+        return chunk
+
+    def _close(self, _=None):
+        # Вызывается в цикле событий, когда выборка уже завершилась
+        self._semaphore.release()
+        app.state.executor.submit(self.batches.close)
+
+    async def release(self):
+        if self._released:
+            return
+        self._released = True
+        if self._fetching is not None and not self._fetching.done():
+            # Курсор закроется, а место вернётся, когда выборка завершится
+            self._fetching.add_done_callback(self._close)
+            return
+        self._semaphore.release()
+        await run_in_executor(self.batches.close)
+
+
+async def stream_records(batches, first_chunk, request, ndjson, timeout):
+    separator = b'\n' if ndjson else b','
+    first = True
+    chunk = first_chunk
+    if not ndjson:
+        yield b'['
+    try:
+        while chunk is not None:
+            if request is not None and await request.is_disconnected():
+                logger.info('Клиент отключился, выгрузка прервана')
+                return
+            records = await run_in_executor(encode_records, chunk)
+            if records:
+                body = separator.join(records)
+                if ndjson:
+                    yield body + separator
+                else:
+                    yield body if first else separator + body
+                first = False
+            chunk = await batches.fetch(timeout)
+    except TimeoutError:
+        # Статус уже отправлен: ответ обрывается без закрывающей скобки,
+        # чтобы клиент не принял неполные данные за весь результат
+        logger.warning('Порция не получена за %s с, ответ оборван', timeout)
+        raise
+    finally:
+        await batches.release()
+    if not ndjson:
+        yield b']'
+
+
+async def open_batches(config_name, config, query, params):
+    if config_name not in semaphores:
+        semaphores[config_name] = Semaphore(config.get('max_concurrency', 4))
+    semaphore = semaphores[config_name]
+    await semaphore.acquire()
+
+    batches = script_chunks(
+        config['db'],
+        query,
+        config.get('chunksize', 10000),
+        params
+    )
+    batches = Batches(batches, semaphore)
+    # Первую порцию получаем до начала ответа, чтобы ошибка или таймаут
+    # запроса вернулись клиенту статусом, а не оборванным телом
+    try:
+        first_chunk = await batches.fetch(config.get('timeout'))
+    except BaseException:
+        await batches.release()
+        raise
+    return batches, first_chunk
 
 
 @app.get("/ca/{config_name}")
 async def api_data(config_name, request: Request):
     parameters = dict(request.query_params)
     config = read_config(f'{config_name}.yml')
-    print(config['query'].format(**parameters))
-    result = script(config['db'], config['query'].format(**parameters))
+    query, params = render_query(config, kwargs=parameters)
+    ndjson = 'application/x-ndjson' in request.headers.get('accept', '')
+    media_type = 'application/x-ndjson' if ndjson else 'application/json'
+    timeout = config.get('timeout')
+    # Значения параметров в лог не пишутся
+    logger.debug('%s: %s', config_name, query)
 
-    json_compatible_item_data = jsonable_encoder(
-        [{k: v for k, v in m.items() if pd.notnull(v)} for m in
-         result.to_dict(orient='records')]
+    try:
+        if 'cache_ttl' in config:
+            async def compute():
+                batches, first_chunk = await open_batches(
+                    config_name, config, query, params
+                )
+                return b''.join([
+                    part async for part in stream_records(
+                        batches, first_chunk, None, ndjson, timeout
+                    )
+                ])
+
+            body = await response_cache.get_or_compute(
+                make_key(config_name, parameters, ndjson),
+                config['cache_ttl'],
+                compute
+            )
+            return Response(body, media_type=media_type)
+
+        batches, first_chunk = await open_batches(
+            config_name, config, query, params
+        )
+    except TimeoutError:
+        return JSONResponse(
+            {'detail': f'Запрос не выполнился за {timeout} с'},
+            status_code=504
+        )
+
+    return StreamingResponse(
+        stream_records(batches, first_chunk, request, ndjson, timeout),
+        media_type=media_type,
+        background=BackgroundTask(batches.release)
     )
 
-    return JSONResponse(json_compatible_item_data)
 
 if __name__ == "__main__":
     server_config = read_config('server.yml')
+    app.state.db_workers = server_config.get('db_workers', 8)
+    response_cache.max_bytes = server_config.get(
+        'cache_max_bytes', response_cache.max_bytes
+    )
     uvicorn.run(
         app,
         host=server_config['host'],